@@ -12,6 +12,8 @@ from ...backend.pagegetter import ProductPageGetter
 from ...backend.worksheet import WorksheetImporter
 from ...backend.downloader import ImageDownloader
 from ...backend.utils import IntegrityChecker, Archiver
+from ...backend.pipeline import run_pipeline
+from ...backend.resources import SharedResources
 from ...backend.poonto.imagecropper import resize_image
 
 supplier_path = Path(__file__).parent
@@ -36,9 +38,11 @@ class SupplierPageGetter(ProductPageGetter):
         to the Product's page if it's not provided
         For example:
 
-        import requests
+        self.http is a shared, pooled requests.Session wrapper.
+        Use it instead of requests.get to reuse connections.
+
         search_api_url = 'https://www.suppliersite.com/search_handler?query={}'
-        resp = requests.get(search_api_url.format(sku))
+        resp = self.http.get(search_api_url.format(sku))
         results = resp.json()['Products']
         if results:
             return results[0]['product_page_url']
@@ -77,15 +81,25 @@ class SupplierImageDownloader(ImageDownloader):
     '''
     Class that handles downloading and transforming
     the images.
+
+    Transformed images are shared through the image store
+    by transform_key and transform_params. Give your
+    transformation its own name, or reuse the name of an
+    identical one from another supplier. Put every setting
+    that changes the result in transform_params, so images
+    made with old settings aren't reused.
     '''
 
+    transform_key = 'suppliername-transformation'
+    transform_params = {'dimensions': (740, 740)}
+
     def transform_image(self, image: bytes, filename: str) -> bytes:
         '''
-        Warning: Currently the program supports only
-        concurrency through the threading module as
-        it's a good way to improve network IO performance
-        but the transformations will be single threaded
-        due to the GIL
+        Note: Images are downloaded on threads, but this
+        method runs on a separate pool of processes, one
+        per core, so transformations are not limited by
+        the GIL. The downloader object is pickled to get
+        there, so keep any state it needs picklable.
 
         The image parameter holds the downloaded image
         as if getting the requests.Response.content
@@ -115,20 +129,31 @@ class SupplierImageDownloader(ImageDownloader):
         raise NotImplementedError()
 
 
-def main():
+def main(engine: str = 'threads', stream: bool = True, incremental: bool = False,
+         filename: str | None = None, resources: SharedResources | None = None):
 
     '''
     The function to be called by controller.py.
     Don't attempt to run as top level.
+
+    engine is either 'threads' or 'async'.
+    stream downloads the images while the pages are still being scraped.
+    incremental keeps the images and archives only what changed since the last run.
+    filename is the file to read instead of the one on the command line, and
+    resources the pools shared with other suppliers running at the same time.
     '''
 
-    ws = WorksheetImporter(supplier_path=supplier_path).worksheet
-    SupplierPageGetter(ws, supplier_path,
-                       'Title', 'ProductCode', 'ProductURL',
-                       failed_only=False).run()
-    ImageDownloader(supplier_path=supplier_path).run()
+    columns = ['Title', 'ProductCode', 'ProductURL']
+    ws = WorksheetImporter(supplier_path=supplier_path, columns=columns,
+                           filename=filename).worksheet
+    page_getter = SupplierPageGetter(ws, supplier_path, *columns, failed_only=False)
+    archiver = Archiver(supplier_path, 'SupplierName', incremental=incremental)
+    downloader = SupplierImageDownloader(supplier_path=supplier_path, on_image=archiver.add,
+                                         resources=resources)
+    run_pipeline(page_getter, downloader, engine=engine, stream=stream)
     ic = IntegrityChecker(log=True, supplier_path=supplier_path)
-    Archiver(supplier_path, 'SupplierName', ic).run()
+    archiver.integrity = bool(ic)
+    archiver.run()
 
 
 if __name__ == '__main__':
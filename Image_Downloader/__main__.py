@@ -1,11 +1,29 @@
+import argparse
 import importlib
+import pathlib
 import sys
 
+from .backend import jobservice
+from .backend.orchestrator import Orchestrator, load_jobs
+
 def main():
+    engine = 'async' if '--async' in sys.argv else 'threads'
+    stream = '--no-stream' not in sys.argv
+    incremental = '--incremental' in sys.argv
+    sys.argv = [arg for arg in sys.argv if arg not in ('--async', '--no-stream', '--incremental')]
+
     if len(sys.argv) == 2 and sys.argv[1] in ['-h', '--help']:
         print('''Poonto Downloader:
     Usage:
-    poonto-downloader 'suppliername' 'path/to/file'
+    poonto-downloader 'suppliername' 'path/to/file' [--async] [--no-stream] [--incremental]
+
+    --async runs the scraping and downloading on an asyncio event loop
+    instead of threads. Requires aiohttp (pip install Image_Downloader[async]).
+    --no-stream waits for every product page to be scraped before downloading
+    the images, instead of downloading them as their pages are parsed.
+    --incremental keeps the images between runs and only archives the images
+    that are new or changed since the last run, with a removed.txt listing the
+    images that are gone.
 
     It's good practice to enclose arguments with '' to avoid problems with spaces.
     Example
@@ -19,6 +37,9 @@ def main():
             
     Images are automatically transformed to 740x740
     A zip will be created in the directory with the naming scheme [suppliername]-[date].zip
+
+    To run several suppliers at once use poonto-orchestrator.
+    To queue runs over HTTP use poonto-service.
             ''')
         sys.exit(0)
 
@@ -30,7 +51,65 @@ def main():
         sys.exit(1)
 
     supplier_module = importlib.import_module(f'.suppliers.{sys.argv[1]}.__main__', 'Image_Downloader')
-    supplier_module.main()
+    supplier_module.main(engine=engine, stream=stream, incremental=incremental)
+
+
+def orchestrate():
+    parser = argparse.ArgumentParser(
+        prog='poonto-orchestrator',
+        description='''Runs several suppliers at once in one process, sharing the connections,
+        the transform processes and the download budgets between them.''',
+        epilog='''The job list is a JSON list of jobs, for example
+        [{"supplier": "kentia", "file": "kentia.xlsx"},
+         {"supplier": "artelibre", "file": "feed.xml", "engine": "async", "incremental": true}].
+        Only the supplier is required, engine defaults to threads, stream to true
+        and incremental to false.'''
+    )
+    parser.add_argument('jobs', help='path to the job list')
+    parser.add_argument('--parallel', type=int, default=None,
+                        help='how many suppliers run at once, all by default')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='transform processes shared by the suppliers, the number of cores by default')
+    parser.add_argument('--max-requests', type=int, default=128,
+                        help='requests in flight to all the suppliers together')
+    args = parser.parse_args()
+    # The suppliers read their file from argv when they aren't given one
+    sys.argv = sys.argv[:1]
+
+    try:
+        jobs = load_jobs(args.jobs)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    orchestrator = Orchestrator(jobs, max_parallel=args.parallel,
+                                transform_processes=args.processes,
+                                max_requests=args.max_requests)
+    sys.exit(0 if orchestrator.run() else 1)
+
+
+def serve():
+    parser = argparse.ArgumentParser(
+        prog='poonto-service',
+        description='''Runs the job service. Clients submit supplier jobs over HTTP, poll their
+        progress, follow their logs and download their archives.''',
+        epilog='''Submit a job with POST /jobs, either as JSON such as
+        {"supplier": "kentia", "file": "/path/to/kentia.xlsx"} or by uploading the file with
+        the options in the query, /jobs?supplier=kentia&filename=kentia.xlsx.
+        Then GET /jobs/<id>, /jobs/<id>/logs and /jobs/<id>/archive.'''
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--data-dir', default='poonto-jobs',
+                        help='where the queue, the logs and the archives are kept')
+    parser.add_argument('--workers', type=int, default=2, help='how many jobs run at once')
+    parser.add_argument('--max-queued', type=int, default=100,
+                        help='how many jobs can wait, further submissions are refused')
+    parser.add_argument('--max-queued-per-client', type=int, default=10,
+                        help='how many jobs of a single client can wait')
+    args = parser.parse_args()
+    jobservice.serve(pathlib.Path(args.data_dir), host=args.host, port=args.port,
+                     workers=args.workers, max_queued=args.max_queued,
+                     max_queued_per_client=args.max_queued_per_client)
 
 
 if __name__ == "__main__":
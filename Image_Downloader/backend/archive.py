@@ -0,0 +1,260 @@
+'''
+Writes the archives of the downloaded images, in the background and in volumes,
+and keeps the manifest of the incremental archives.
+'''
+
+import hashlib
+import os
+import pathlib
+import sqlite3
+import threading
+import zlib
+from collections.abc import Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue
+from zipfile import ZIP64_LIMIT, ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+# Already compressed, deflating them costs time and saves nothing
+STORED_SUFFIXES = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.zip'}
+# Bytes of the zip records around every entry, without the name, and at the end of a volume
+LOCAL_HEADER_SIZE = 30
+CENTRAL_HEADER_SIZE = 46
+END_RECORD_SIZE = 22
+
+
+class ArchiveWriter:
+    '''
+    Writes files to zip volumes in destination on a thread of its own, so the
+    callers of add() don't wait for the archive.
+
+    Images are stored as they are and everything else, like the logs, is
+    deflated with compresslevel on threads of their own, as soon as it's added,
+    so the writer only copies the compressed bytes. When the next file, with its
+    zip headers and the central directory, would take a volume past volume_size
+    bytes, a new volume is started, so every volume stays under the upload limit
+    unless a single file is larger. Pass None for a single volume.
+
+    Volumes are written under temporary names and renamed by close(). A single
+    volume is named name.zip, more are named name-part1.zip, name-part2.zip...
+    An existing archive isn't overwritten, the new one is named name-2.zip etc.
+    '''
+
+    def __init__(self, destination: pathlib.Path, name: str,
+                 volume_size: int | None = None, compresslevel: int = 6):
+        destination.mkdir(parents=True, exist_ok=True)
+        self.destination = destination
+        self.name = name
+        self.volume_size = volume_size
+        self.compresslevel = compresslevel
+        self.volumes: list[pathlib.Path] = []
+        self.errors: list[tuple[pathlib.Path, Exception]] = []
+        self._zip: ZipFile | None = None
+        self._directory_size = 0
+        self._deflaters = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        self._queue: Queue[tuple[pathlib.Path, str, Future | None] | None] = Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, file: pathlib.Path, arcname: str | None = None) -> None:
+        '''
+        Queues file to be written to the archive as arcname, its name by default.
+        '''
+        deflated = None
+        if file.suffix.lower() not in STORED_SUFFIXES:
+            deflated = self._deflaters.submit(self._deflate, file)
+        self._queue.put((file, file.name if arcname is None else arcname, deflated))
+
+    def close(self) -> list[pathlib.Path]:
+        '''
+        Waits for the queued files to be written and returns the finished volumes.
+        '''
+        self._stop()
+        finished = []
+        for volume, target in zip(self.volumes, self._targets()):
+            os.replace(volume, target)
+            finished.append(target)
+        self.volumes = finished
+        return finished
+
+    def discard(self) -> None:
+        '''
+        Stops writing and deletes the volumes.
+        '''
+        self._stop()
+        for volume in self.volumes:
+            volume.unlink(missing_ok=True)
+        self.volumes = []
+
+    def _targets(self) -> list[pathlib.Path]:
+        copy = 1
+        while True:
+            name = self.name if copy == 1 else f'{self.name}-{copy}'
+            if len(self.volumes) == 1:
+                targets = [self.destination / f'{name}.zip']
+            else:
+                targets = [self.destination / f'{name}-part{number}.zip'
+                           for number in range(1, len(self.volumes) + 1)]
+            if not any(target.exists() for target in targets):
+                return targets
+            copy += 1
+
+    def _stop(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        self._deflaters.shutdown()
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    def _run(self) -> None:
+        while (item := self._queue.get()) is not None:
+            file, arcname, deflated = item
+            try:
+                compressed = None if deflated is None else deflated.result()
+                if compressed is not None:
+                    self._write_deflated(file, arcname, *compressed)
+                else:
+                    self._write(file, arcname, deflate=deflated is not None)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                # Anything left uncaught would end the thread and hang close()
+                print(f'Could not archive {file}: {e}')
+                self.errors.append((file, e))
+
+    def _deflate(self, file: pathlib.Path) -> tuple[bytes, int, int] | None:
+        '''
+        The raw deflate stream, CRC and size of file. zlib releases the GIL, so
+        files are compressed in parallel. None for files too large to hold in
+        memory, which the writer deflates itself.
+        '''
+        if file.stat().st_size >= ZIP64_LIMIT:
+            return None
+        data = file.read_bytes()
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush(), zlib.crc32(data), len(data)
+
+    def _write(self, file: pathlib.Path, arcname: str, deflate: bool = False) -> None:
+        self._make_room(arcname, file.stat().st_size)
+        self._zip.write(file, arcname, # type: ignore
+                        compress_type=ZIP_DEFLATED if deflate else ZIP_STORED,
+                        compresslevel=self.compresslevel if deflate else None)
+
+    def _write_deflated(self, file: pathlib.Path, arcname: str,
+                        data: bytes, crc: int, size: int) -> None:
+        '''
+        Appends a deflated entry as it was compressed by _deflate. zipfile can't
+        take compressed data, so the entry is recorded the way ZipFile.write does.
+        '''
+        self._make_room(arcname, len(data))
+        archive = self._zip
+        assert archive is not None and archive.fp is not None
+        info = ZipInfo.from_file(file, arcname)
+        info.compress_type = ZIP_DEFLATED
+        info.file_size = size
+        info.compress_size = len(data)
+        info.CRC = crc
+        info.header_offset = archive.fp.tell()
+        archive.fp.write(info.FileHeader(zip64=False))
+        archive.fp.write(data)
+        archive.filelist.append(info)
+        archive.NameToInfo[info.filename] = info
+        archive.start_dir = archive.fp.tell()
+        archive._didModify = True # pylint: disable=protected-access
+
+    def _make_room(self, arcname: str, size: int) -> None:
+        '''
+        Starts a new volume if an entry of size bytes named arcname wouldn't fit
+        in the current one, together with its headers and the central directory.
+        '''
+        name_size = len(arcname.encode())
+        needed = LOCAL_HEADER_SIZE + name_size + size + CENTRAL_HEADER_SIZE + name_size
+        if self._zip is None or (self.volume_size is not None and self._zip.filelist and
+                                 self._zip.fp.tell() + self._directory_size + # type: ignore
+                                 needed + END_RECORD_SIZE > self.volume_size):
+            self._next_volume()
+        self._directory_size += CENTRAL_HEADER_SIZE + name_size
+
+    def _next_volume(self) -> None:
+        if self._zip is not None:
+            self._zip.close()
+        volume = self.destination / \
+                 f'.{self.name}-{len(self.volumes) + 1}.{os.getpid()}.{threading.get_ident()}.zip.tmp'
+        self.volumes.append(volume)
+        self._zip = ZipFile(volume, 'w')
+        self._directory_size = 0
+
+
+class ArchiveManifest:
+    '''
+    The images in the archives made so far, with their size, modification time
+    and sha256, in a SQLite file. The size and time spare hashing the images
+    that weren't touched since.
+
+    The entries are read once, so changed() compares with the manifest as it
+    was when it was opened, until update() records the new archive.
+    '''
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                '''CREATE TABLE IF NOT EXISTS manifest (
+                       name TEXT PRIMARY KEY,
+                       size INTEGER,
+                       mtime INTEGER,
+                       hash TEXT
+                   )'''
+            )
+        self.known = self.entries()
+        self._touched: list[tuple[pathlib.Path, str]] = []
+
+    def entries(self) -> dict[str, tuple[int, int, str]]:
+        '''
+        The size, modification time and hash of every archived image by name.
+        '''
+        with self.lock:
+            return {name: (size, mtime, digest) for name, size, mtime, digest
+                    in self.connection.execute('SELECT * FROM manifest')}
+
+    def changed(self, file: pathlib.Path) -> str | None:
+        '''
+        Returns the sha256 of file if it's new or changed since it was archived,
+        otherwise None. A file that was only touched is remembered with its new
+        modification time by the next update().
+        '''
+        stat = file.stat()
+        size, mtime, digest = self.known.get(file.name, (None, None, None))
+        if size == stat.st_size and mtime == stat.st_mtime_ns:
+            return None
+        new_digest = hashlib.sha256(file.read_bytes()).hexdigest()
+        if new_digest == digest:
+            with self.lock:
+                self._touched.append((file, digest))
+            return None
+        return new_digest
+
+    def update(self, files: Iterable[tuple[pathlib.Path, str]], removed: Iterable[str]) -> None:
+        '''
+        Records files with their hashes and forgets the removed names.
+        '''
+        with self.lock:
+            files = [*self._touched, *files]
+            self._touched = []
+        rows = []
+        for file, digest in files:
+            stat = file.stat()
+            rows.append((file.name, stat.st_size, stat.st_mtime_ns, digest))
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?)', rows)
+            self.connection.executemany('DELETE FROM manifest WHERE name = ?',
+                                        [(name,) for name in removed])
+        self.known = self.entries()
+
+    def close(self) -> None:
+        '''
+        Closes the database connection.
+        '''
+        with self.lock:
+            self.connection.close()
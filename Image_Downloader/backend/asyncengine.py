@@ -0,0 +1,309 @@
+'''
+An asyncio alternative to the threaded ProductPageGetter.run and ImageDownloader.run.
+It drives the same supplier hooks (search, parse_html, transform_image) but keeps
+all the network IO on a single event loop, so hundreds of requests can be in flight
+without an OS thread each.
+
+Requires the optional aiohttp dependency: pip install Image_Downloader[async]
+'''
+
+import asyncio
+from collections import defaultdict, deque
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from .pagegetter import ProductPageGetter
+from .downloader import ImageDownloader
+from .session import get_client
+from .throttle import Throttle, parse_retry_after
+from .spool import ImageTooLarge
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class HostLimiter:
+    '''
+    Caps the number of requests in flight, both in total and per host, and
+    waits for a slot of throttle, the adaptive per host limiter shared with
+    the threaded code.
+    '''
+
+    def __init__(self, per_host: int, total: int, throttle: Throttle):
+        self.total = asyncio.Semaphore(total)
+        self.hosts: defaultdict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(per_host)
+        )
+        self.throttle = throttle
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        '''
+        Holds a slot for the host of url for the duration of the block.
+        Yields the throttle ticket to report the response status to.
+        A timeout or a dropped connection while reading the body counts as a
+        failed request, even after the status was reported.
+        '''
+        async with self.total, self.hosts[urlparse(url).netloc]:
+            async with self.throttle.slot_async(url) as ticket:
+                try:
+                    yield ticket
+                except (asyncio.TimeoutError, aiohttp.ClientConnectionError,
+                        aiohttp.ClientPayloadError) as e:
+                    ticket.error = e
+                    raise
+
+
+class AsyncEngine:
+    '''
+    Runs a ProductPageGetter (optional) and an ImageDownloader on an event loop.
+
+    The blocking hooks, search and parse_html, run on the loop's default
+    thread pool so they don't stall the network IO. transform_image runs on
+    the downloader's transform processes.
+    links.txt and logs.txt are written in the same format and order as the
+    threaded classes, so the rest of the pipeline is unchanged.
+    With stream set, images are downloaded as soon as their page is parsed
+    instead of after the whole worksheet has been scraped.
+
+    Usage:
+    AsyncEngine(SupplierImageDownloader(supplier_path),
+                SupplierPageGetter(ws, supplier_path, 'Title', 'ProductCode', 'ProductURL')).run()
+    '''
+
+    def __init__(self, downloader: ImageDownloader,
+                 page_getter: ProductPageGetter | None = None,
+                 per_host: int = 32,
+                 max_in_flight: int = 200,
+                 timeout: float = 10,
+                 stream: bool = False):
+
+        if aiohttp is None:
+            raise ImportError('The async engine requires aiohttp. '
+                              'Install it with pip install Image_Downloader[async]')
+        self.downloader = downloader
+        self.page_getter = page_getter
+        self.per_host = max(1, per_host)
+        self.max_in_flight = max(1, max_in_flight)
+        self.timeout = timeout
+        self.stream = stream
+        self.limiter: HostLimiter
+        self.url_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    def run(self) -> None:
+        '''
+        The class' high level API
+        '''
+        asyncio.run(self._run())
+
+    async def _run(self) -> None:
+        self.limiter = HostLimiter(self.per_host, self.max_in_flight, get_client().throttle)
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, limit_per_host=self.per_host)
+        async with aiohttp.ClientSession(
+            headers=self.downloader.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            connector=connector
+        ) as session:
+            self.downloader._begin_run()
+            self.downloader._start_transform_stage()
+            completed = False
+            try:
+                if self.page_getter is None:
+                    await self._download(session, self._read_links())
+                elif self.stream:
+                    links: asyncio.Queue[tuple[str, str] | None] = asyncio.Queue()
+                    download = asyncio.create_task(self._download(session, self._queued_links(links)))
+                    try:
+                        await self._scrape(session, lambda *link: links.put_nowait(link))
+                    finally:
+                        links.put_nowait(None)
+                        await download
+                else:
+                    await self._scrape(session)
+                    await self._download(session, self._read_links())
+                completed = True
+            finally:
+                self.downloader._stop_transform_stage()
+                self.downloader._end_run(completed)
+                if self.page_getter is not None:
+                    self.page_getter.journal.flush()
+
+    async def _scrape(self, session, on_link=None) -> None:
+        getter = self.page_getter
+        assert getter is not None
+        plan = await asyncio.to_thread(lambda: getter.resolve_searches(getter.plan()))
+
+        with (
+            (getter.app_path / 'logs.txt').open('w') as log_file,
+            (getter.app_path / 'links.txt').open('a' if getter.failed_only else 'w') as links_file
+        ):
+            pending: deque[asyncio.Task] = deque()
+            for title, sku, url, action in plan.itertuples(index=False, name=None):
+                pending.append(asyncio.create_task(
+                    self._process_product(session, title, sku, url, action)
+                ))
+                if len(pending) >= self.max_in_flight:
+                    getter._write_result(await pending.popleft(), log_file, links_file, on_link)
+            while pending:
+                getter._write_result(await pending.popleft(), log_file, links_file, on_link)
+        getter.journal.end('scrape')
+        await asyncio.to_thread(getter.cache.evict)
+
+    async def _process_product(self, session, title: str, sku: str, url: str, action: str):
+        getter = self.page_getter
+        assert getter is not None
+        if action == 'journaled':
+            return getter._journaled[sku]
+        resp = None
+        if action == 'cached':
+            resp = await asyncio.to_thread(getter._cached_page, title, sku)
+        if resp is None:
+            resp = await self._request_page(session, title, sku, url)
+        return await asyncio.to_thread(getter._parse_product, title, sku, url, resp)
+
+    async def _request_page(self, session, title: str, sku: str,
+                            product_url: str) -> requests.Response | None:
+        getter = self.page_getter
+        assert getter is not None
+
+        cached, url, entry = await asyncio.to_thread(getter._plan_request, title, sku, product_url)
+        if cached is not None:
+            return cached
+        if url is None:
+            return None
+
+        try:
+            print(f'Requesting page {url}')
+            async with self.limiter.slot(url) as ticket:
+                async with session.get(url, headers=getter.cache.validators(entry)) as r:
+                    ticket.report(r.status, r.headers)
+                    resp = _to_response(r, await r.read())
+            resp.raise_for_status()
+            print(f'Request for page {sku} - {title} successful')
+        except requests.HTTPError as e:
+            print(f'{e} Failed to get page for {title} - {sku}. \
+                    GET Request return status {resp.status_code}')
+        except asyncio.TimeoutError as e:
+            print(f'{e} Failed to get page for {title} - {sku}. Connection timed out')
+            return None
+        except (aiohttp.ClientError, ValueError) as e:
+            print(f'{e} Failed to get page for {title} - {sku}.')
+            return None
+
+        return await asyncio.to_thread(getter._store_response, title, sku, resp, entry)
+
+    async def _read_links(self) -> AsyncIterator[tuple[str, str]]:
+        with self.downloader.links_file.open() as links_io:
+            for line in links_io:
+                line = line.strip()
+                if not line:
+                    continue
+                filename, url = line.split('|')
+                yield filename, url
+
+    @staticmethod
+    async def _queued_links(links: asyncio.Queue) -> AsyncIterator[tuple[str, str]]:
+        while (link := await links.get()) is not None:
+            yield link
+
+    async def _download(self, session, links: AsyncIterator[tuple[str, str]]) -> None:
+        pending: set[asyncio.Task] = set()
+        async for filename, url in links:
+            if len(pending) >= self.max_in_flight:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.add(asyncio.create_task(self._download_item(session, filename, url)))
+        if pending:
+            await asyncio.wait(pending)
+
+    async def _download_item(self, session, filename: str, url: str) -> None:
+        downloader = self.downloader
+        conditional = await asyncio.to_thread(downloader._conditional_headers, filename, url)
+        if conditional is None:
+            return
+        downloader.journal.record('download', filename, 'started')
+
+        async with self.url_locks[url]:
+            if filename not in downloader.existing_images and \
+               await asyncio.to_thread(downloader._reuse_stored, filename, url):
+                return
+            attempt = 1
+            while (delay := await self._fetch_item(session, filename, url,
+                                                   conditional, attempt)) is not None:
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _fetch_item(self, session, filename: str, url: str,
+                          conditional: dict[str, str], attempt: int) -> float | None:
+        '''
+        Downloads the image once. Returns how long to wait before retrying it,
+        or None if it shouldn't be retried.
+        '''
+        downloader = self.downloader
+        log = downloader._new_log(filename, url)
+        log['attempts'] = attempt
+        spool = None
+        headers = {}
+        stale = False
+        downloader.retry_policy.request()
+        try:
+            async with self.limiter.slot(url) as ticket:
+                async with session.get(url, headers=conditional) as r:
+                    ticket.report(r.status, r.headers)
+                    if r.status == 304:
+                        if await asyncio.to_thread(downloader._not_modified, filename, url):
+                            return None
+                        stale = True
+                    else:
+                        headers = r.headers.copy()
+                        log['status_code'] = r.status
+                        log['reason'] = r.reason
+                        r.raise_for_status()
+                        spool = await asyncio.to_thread(downloader._new_spool, r.content_length)
+                        async for chunk in r.content.iter_chunked(downloader.chunk_size):
+                            spool.write(chunk)
+                        spool.close()
+                        log['success'] = True
+        except asyncio.TimeoutError:
+            log['timeout'] = True
+            log['reason'] = 'Timed out'
+        except ImageTooLarge as e:
+            log['reason'] = str(e)
+        except (aiohttp.ClientError, ValueError) as e:
+            log['reason'] = log['reason'] if log['status_code'] else str(e)
+
+        if stale:
+            # The stored image the request asked about is gone since
+            return await self._fetch_item(session, filename, url, {}, attempt)
+        try:
+            if log['success'] and spool is not None:
+                await asyncio.to_thread(downloader.validators.put, filename, url, headers)
+                await asyncio.to_thread(downloader._submit_image, spool, log, headers)
+                return None
+            if spool is not None:
+                spool.release()
+            return await asyncio.to_thread(downloader._retry_or_fail, log,
+                                           parse_retry_after(headers.get('Retry-After')))
+        except Exception as e: # pylint: disable=broad-exception-caught
+            print(f'Unexpected error while downloading {url}: {e}')
+            return None
+
+
+def _to_response(r, body: bytes) -> requests.Response:
+    '''
+    Wraps an aiohttp response in a requests.Response, so the
+    cache and the parse_html hook see the same object as before.
+    '''
+    resp = requests.Response()
+    resp.status_code = r.status
+    resp.reason = r.reason
+    resp.url = str(r.url)
+    resp.headers = CaseInsensitiveDict(r.headers)
+    resp.encoding = r.charset
+    resp._content = body
+    return resp
@@ -0,0 +1,321 @@
+'''
+Persistent stores for downloaded product pages and image validators.
+'''
+
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+import zlib
+from typing import NamedTuple
+
+import pandas as pd
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class CacheEntry(NamedTuple):
+    '''
+    A cached page and the time it was last fetched or revalidated.
+    '''
+    response: requests.Response
+    fetched: float
+
+
+class PageCache:
+    '''
+    Stores product pages in a single SQLite file keyed by sku.
+    Bodies are zlib compressed and kept together with the status, url and headers,
+    so the page comes back as a requests.Response.
+
+    Entries older than max_age seconds are considered stale. Stale entries are
+    still returned, so the caller can revalidate them with the ETag/Last-Modified
+    headers from validators() instead of downloading the page again.
+    With revalidate set, entries that have validators are stale on every run,
+    since a conditional request that answers 304 costs almost nothing.
+
+    evict() removes entries that haven't been used for expire_after seconds and
+    then the least recently used entries until the stored bodies fit max_size bytes.
+    Pass None to disable any of the limits.
+    '''
+
+    def __init__(self, path: pathlib.Path,
+                 max_age: float | None = 7 * 24 * 3600,
+                 expire_after: float | None = 90 * 24 * 3600,
+                 max_size: int | None = 2 * 1024 ** 3,
+                 revalidate: bool = True):
+
+        self.path = path
+        self.max_age = max_age
+        self.revalidate = revalidate
+        self.expire_after = expire_after
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                '''CREATE TABLE IF NOT EXISTS pages (
+                       key TEXT PRIMARY KEY,
+                       url TEXT,
+                       status INTEGER,
+                       reason TEXT,
+                       encoding TEXT,
+                       headers TEXT,
+                       body BLOB,
+                       size INTEGER,
+                       fetched REAL,
+                       accessed REAL
+                   )'''
+            )
+            columns = {row[1] for row in self.connection.execute('PRAGMA table_info(pages)')}
+            if 'validated' not in columns:
+                self.connection.execute('ALTER TABLE pages ADD COLUMN validated INTEGER DEFAULT 0')
+                self.connection.execute(
+                    '''UPDATE pages SET validated = (headers LIKE '%"etag":%'
+                                                   OR headers LIKE '%"last-modified":%')'''
+                )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS pages_plan ON pages (key, fetched, validated)'
+            )
+
+    def get(self, key: str) -> CacheEntry | None:
+        '''
+        Returns the cached page for key or None.
+        '''
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT url, status, reason, encoding, headers, body, fetched '
+                'FROM pages WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE pages SET accessed = ? WHERE key = ?',
+                                    (time.time(), key))
+
+        url, status, reason, encoding, headers, body, fetched = row
+        resp = requests.Response()
+        resp.url = url
+        resp.status_code = status
+        resp.reason = reason
+        resp.encoding = encoding
+        resp.headers = CaseInsensitiveDict(json.loads(headers))
+        resp._content = zlib.decompress(body)
+        return CacheEntry(resp, fetched)
+
+    def put(self, key: str, resp: requests.Response) -> None:
+        '''
+        Stores the response for key, replacing any older entry.
+        '''
+        body = zlib.compress(resp.content)
+        now = time.time()
+        validated = bool(self.validators(CacheEntry(resp, now)))
+        with self.lock, self.connection:
+            self.connection.execute(
+                '''INSERT OR REPLACE INTO pages
+                   (key, url, status, reason, encoding, headers, body, size, fetched, accessed,
+                    validated)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (key, resp.url, resp.status_code, resp.reason, resp.encoding,
+                 json.dumps(dict(resp.headers)), body, len(body), now, now, validated)
+            )
+
+    def touch(self, key: str, resp: requests.Response) -> None:
+        '''
+        Marks the entry as fresh after a 304 Not Modified response
+        and picks up any updated validators.
+        '''
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT headers FROM pages WHERE key = ?',
+                                          (key,)).fetchone()
+            if row is None:
+                return
+            headers = CaseInsensitiveDict(json.loads(row[0]))
+            for name in ('ETag', 'Last-Modified', 'Cache-Control', 'Expires'):
+                if name in resp.headers:
+                    headers[name] = resp.headers[name]
+            now = time.time()
+            validated = 'ETag' in headers or 'Last-Modified' in headers
+            self.connection.execute(
+                'UPDATE pages SET headers = ?, fetched = ?, accessed = ?, validated = ? '
+                'WHERE key = ?',
+                (json.dumps(dict(headers)), now, now, validated, key)
+            )
+
+    def is_stale(self, entry: CacheEntry) -> bool:
+        '''
+        True if the entry has to be checked with the server before use.
+        '''
+        if self.revalidate and self.validators(entry):
+            return True
+        return self.max_age is not None and time.time() - entry.fetched > self.max_age
+
+    def fresh_many(self, keys: pd.Series) -> tuple[pd.Series, pd.Series]:
+        '''
+        Bulk version of get and is_stale for planning a run. Returns two boolean
+        series aligned with keys: whether each key is cached, and whether the
+        cached page can be used without asking the server.
+        Reads only the pages_plan index, never the stored bodies.
+        '''
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT key, fetched, validated FROM pages INDEXED BY pages_plan'
+            ).fetchall()
+        table = pd.DataFrame(rows, columns=['key', 'fetched', 'validated']).set_index('key')
+        info = table.reindex(keys.to_numpy())
+        cached = pd.Series(info['fetched'].notna().to_numpy(), index=keys.index)
+        fresh = cached.copy()
+        if self.revalidate:
+            fresh &= ~(info['validated'].fillna(0).to_numpy() == 1)
+        if self.max_age is not None:
+            fresh &= (time.time() - info['fetched'].fillna(0).to_numpy()) <= self.max_age
+        return cached, fresh
+
+    @staticmethod
+    def validators(entry: CacheEntry | None) -> dict[str, str]:
+        '''
+        The conditional request headers for revalidating the entry.
+        '''
+        if entry is None:
+            return {}
+        headers = {}
+        if etag := entry.response.headers.get('ETag'):
+            headers['If-None-Match'] = etag
+        if last_modified := entry.response.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def evict(self) -> int:
+        '''
+        Applies the expire_after and max_size limits.
+        Returns the number of removed entries.
+        '''
+        removed = 0
+        with self.lock, self.connection:
+            if self.expire_after is not None:
+                removed += self.connection.execute(
+                    'DELETE FROM pages WHERE accessed < ?', (time.time() - self.expire_after,)
+                ).rowcount
+
+            if self.max_size is not None:
+                total = self.connection.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM pages'
+                ).fetchone()[0]
+                if total > self.max_size:
+                    cursor = self.connection.execute(
+                        'SELECT key, size FROM pages ORDER BY accessed'
+                    )
+                    keys = []
+                    for key, size in cursor:
+                        if total <= self.max_size:
+                            break
+                        keys.append((key,))
+                        total -= size
+                    self.connection.executemany('DELETE FROM pages WHERE key = ?', keys)
+                    removed += len(keys)
+        return removed
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            return self.connection.execute(
+                'SELECT 1 FROM pages WHERE key = ?', (key,)
+            ).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def close(self) -> None:
+        '''
+        Closes the database connection.
+        '''
+        with self.lock:
+            self.connection.close()
+
+
+def conditional_headers(validators) -> dict[str, str]:
+    '''
+    The headers asking whether the response with the ETag and Last-Modified
+    validators changed. Empty if there are none.
+    '''
+    headers = {}
+    if validators.get('ETag'):
+        headers['If-None-Match'] = validators['ETag']
+    if validators.get('Last-Modified'):
+        headers['If-Modified-Since'] = validators['Last-Modified']
+    return headers
+
+
+class ValidatorStore:
+    '''
+    Remembers the ETag/Last-Modified headers of downloaded images, keyed by filename,
+    so a re-run can ask the server whether the image changed instead of downloading it.
+    '''
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                '''CREATE TABLE IF NOT EXISTS validators (
+                       key TEXT PRIMARY KEY,
+                       url TEXT,
+                       etag TEXT,
+                       last_modified TEXT,
+                       checked REAL
+                   )'''
+            )
+
+    def headers_for(self, key: str, url: str) -> dict[str, str] | None:
+        '''
+        The conditional request headers for key, or None if nothing usable
+        is stored for this url.
+        '''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT url, etag, last_modified FROM validators WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None or row[0] != url:
+            return None
+        return conditional_headers({'ETag': row[1], 'Last-Modified': row[2]}) or None
+
+    def put(self, key: str, url: str, headers) -> None:
+        '''
+        Records the validators from the response headers, if the server sent any.
+        '''
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        with self.lock, self.connection:
+            if not (etag or last_modified):
+                self.connection.execute('DELETE FROM validators WHERE key = ?', (key,))
+                return
+            self.connection.execute(
+                'INSERT OR REPLACE INTO validators VALUES (?, ?, ?, ?, ?)',
+                (key, url, etag, last_modified, time.time())
+            )
+
+    def touch(self, key: str) -> None:
+        '''
+        Records that the image was found unchanged.
+        '''
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE validators SET checked = ? WHERE key = ?',
+                                    (time.time(), key))
+
+    def remove(self, key: str) -> None:
+        '''
+        Forgets the validators for key.
+        '''
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM validators WHERE key = ?', (key,))
+
+    def close(self) -> None:
+        '''
+        Closes the database connection.
+        '''
+        with self.lock:
+            self.connection.close()
@@ -2,23 +2,113 @@
 Downloads images the images as marked on a links.txt
 '''
 
+import json
+import os
 import pathlib
 import threading
-import pprint
+import time
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from queue import Queue
 from abc import abstractmethod
+from collections.abc import Callable, Mapping
+from types import MappingProxyType
 from typing import TextIO
 
 import requests
 
+from .session import get_client
+from .cache import ValidatorStore, conditional_headers
+from .imagestore import ImageStore, materialize, write_object
+from .spool import ByteBudget, ImageTooLarge, Spool
+from .resources import SharedResources
+from .verify import VerificationIndex, check_image
+from .results import ResultStore
+from .journal import RunJournal
+from .retry import RetryPolicy, RetryQueue, error_class
+from .throttle import parse_retry_after
+
 class ImageDownloader:
 
     '''
     Class to be used on supplier scripts. Downloads the images
     and allows the caller to define a method that applies a
     transformation to the image before saving.
+
+    Downloading happens on max_workers threads, but the shared HTTP client
+    only lets as many of them reach a host at once as that host handles
+    well. The transformations run
+    on a separate pool of transform_processes processes (defaults to the
+    number of cores), so they are not limited by the GIL. The downloader
+    object is pickled to reach the processes, so keep the state that
+    transform_image needs picklable. Pass transform_processes=0 to
+    transform on the download threads instead.
+
+    The ETag/Last-Modified headers of every image are kept in validators.sqlite.
+    If an image is already in the images directory, it is requested conditionally
+    and only downloaded and transformed again if the supplier changed it.
+    Images already there without recorded validators are skipped as before.
+
+    Transformed images are kept in an ImageStore shared by all suppliers and
+    hardlinked into the images directory. A URL, or a byte identical image,
+    is downloaded and transformed once per run no matter how many products use
+    it, and later runs only ask the server whether the image changed.
+    Set transform_key to a name for your transformation and transform_params to
+    its parameters, such as the dimensions. Both are part of the store key, so
+    changing a parameter doesn't reuse images made with the old value, while
+    suppliers with the same transform_key and transform_params share their
+    transformed images. Reusing a stored image skips the decode, transform and
+    encode entirely. The store is kept under its max_size at the end of the run,
+    least recently used images go first and those used by the run are kept.
+
+    Timeouts, connection errors, throttling and server errors are retried later
+    in the run with exponential backoff, as decided by retry_policy, on the same
+    threads. The outcome of every image is kept in results.sqlite, which the
+    IntegrityChecker reads, instead of Failed_log files in the images directory.
+
+    Images are streamed to a spool file in the store instead of being held in
+    memory. Images larger than max_image_size bytes are refused, and no more than
+    max_in_flight_bytes of downloaded images wait for their transformation at
+    once. Further downloads wait until the transformations catch up.
+
+    With verify_images set, every transformed image is verified before it's
+    stored and recorded in verified.sqlite, so the IntegrityChecker doesn't open
+    it again.
+
+    Every image is recorded in journal.sqlite as it starts and finishes. If a run
+    is interrupted, the next one resumes it: finished images aren't requested
+    again and images it left half written are deleted and downloaded again.
+
+    on_image is called with the path of every image as soon as it's in the images
+    directory, from the download threads, for example to archive it right away.
+
+    Downloaders of suppliers that run at the same time can be given the same
+    resources, a SharedResources, to share its transform processes and byte budget
+    instead of starting their own. transform_processes and max_in_flight_bytes
+    are ignored then, and the store is evicted once the resources are closed.
     '''
 
-    def __init__(self, supplier_path: pathlib.Path) -> None:
+    transform_key: str | None = None
+    transform_params: Mapping[str, object] = MappingProxyType({})
+    max_image_size: int | None = 50 * 1024 ** 2
+    verify_images: bool = True
+    chunk_size: int = 64 * 1024
+
+    _unpicklable = ('links_io', 'http', 'existing_images', 'validators', 'store', 'results',
+                    'journal', '_journaled', 'retry_policy', 'budget', 'verified', '_transform_pool', '_transform_slots', '_url_locks',
+                    '_locks_guard', '_pending_objects', '_queue', '_workers', '_retries',
+                    '_active_changed', 'on_image', 'resources')
+
+    def __init__(self, supplier_path: pathlib.Path,
+                 max_workers: int = 32,
+                 transform_processes: int | None = None,
+                 image_store: ImageStore | None = None,
+                 retry_policy: RetryPolicy | None = None,
+                 max_in_flight_bytes: int = 256 * 1024 ** 2,
+                 on_image: Callable[[pathlib.Path], None] | None = None,
+                 resources: SharedResources | None = None) -> None:
         self.app_path = supplier_path
         self.links_file = self.app_path / 'links.txt'
         self.out_dir = self.app_path / 'images'
@@ -30,44 +120,307 @@ class ImageDownloader:
             self.out_dir.mkdir()
         self.existing_images: set[str] = {file.name for file in self.out_dir.iterdir()}
         self.links_io: TextIO
+        self.http = get_client()
+        self.validators = ValidatorStore(self.app_path / 'validators.sqlite')
+        self.results = ResultStore(self.app_path / 'results.sqlite')
+        self.journal = RunJournal(self.app_path / 'journal.sqlite')
+        self.verified = VerificationIndex(self.app_path / 'verified.sqlite')
+        self._journaled: set[str] = set()
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self.resources = resources
+        self.budget = ByteBudget(max_in_flight_bytes) if resources is None else resources.budget
+        self.on_image = on_image
+        self.max_workers = max(1, max_workers)
+        if transform_processes is None:
+            transform_processes = os.cpu_count() or 1
+        self.transform_processes = max(0, transform_processes)
+        self._transform_pool: ProcessPoolExecutor | None = None
+        self._transform_slots: threading.BoundedSemaphore | None = None
+        if image_store is None:
+            store_root = self.app_path.parent / '.imagestore'
+            if resources is not None and resources.store_root is not None:
+                store_root = resources.store_root
+            image_store = ImageStore(store_root)
+        self.store = image_store
+        if resources is not None:
+            resources.add_store(self.store)
+        self._run_started = time.time()
+        if self.transform_key is None:
+            self.transform_key = f'{type(self).__module__}.{type(self).__qualname__}'
+        self._url_locks: dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        self._pending_objects: dict[pathlib.Path, list[dict]] = {}
+        self._queue: Queue[tuple[str, str, int] | None] | None = None
+        self._workers: list[threading.Thread] = []
+        self._retries: RetryQueue | None = None
+        # Images queued, downloading or waiting for a retry
+        self._active = 0
+        # Images in the transform processes
+        self._transforming = 0
+        self._active_changed = threading.Condition()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        for key in self._unpicklable:
+            state.pop(key, None)
+        return state
 
     def run(self) -> None:
         '''
         The class' high level API
+
+        Feeds links.txt into a bounded queue that is consumed by
+        max_workers persistent threads, so a slow image only
+        occupies its own slot instead of stalling a whole batch.
+        '''
+        self.start()
+        try:
+            with self.links_file.open() as self.links_io:
+                for line in self.links_io:
+                    line = line.strip()
+                    if not line:
+                        continue
+
+                    filename, url = line.split('|')
+                    self.put(filename, url)
+        except BaseException:
+            self.finish(completed=False)
+            raise
+        self.finish()
+
+    def start(self) -> None:
+        '''
+        Starts the download threads and the transform stage without reading
+        links.txt. Feed images with put() and wait for them with finish().
+        '''
+        self._begin_run()
+        self._queue = Queue(maxsize=self.max_workers * 2)
+        self._workers = [threading.Thread(target=self._worker, args=(self._queue,))
+                         for _ in range(self.max_workers)]
+        self._retries = RetryQueue(self._queue.put)
+        self._start_transform_stage()
+        for worker in self._workers:
+            worker.start()
+
+    def put(self, filename: str, url: str) -> None:
+        '''
+        Queues an image for download. Blocks while the queue is full.
         '''
-        self.links_io = self.links_file.open()
-        queue: list[tuple[str, str]] = []
-        for i, line in enumerate(self.links_io, 1):
-            line = line.strip()
-            if not line:
-                continue
+        if self._queue is None:
+            raise RuntimeError('ImageDownloader.start() has to be called before put()')
+        self._track(1)
+        self._queue.put((filename, url, 1))
 
-            filename, url = line.split('|')
+    def finish(self, completed: bool = True) -> None:
+        '''
+        Waits for every queued image, including the retries,
+        and stops the threads and the transform stage.
+        Pass completed=False if not every image was put, so the
+        next run resumes this one.
+        '''
+        if self._queue is not None:
+            with self._active_changed:
+                while self._active:
+                    self._active_changed.wait()
+            for _ in self._workers:
+                self._queue.put(None)
+            for worker in self._workers:
+                worker.join()
+        if self._retries is not None:
+            self._retries.close()
+        self._queue = None
+        self._workers = []
+        self._retries = None
+        self._stop_transform_stage()
+        self._end_run(completed)
 
-            if i % 8 == 0:
-                self._download(queue)
-                queue.clear()
+    @property
+    def transform_id(self) -> str:
+        '''
+        Identifies the transformation in the store, transform_key and transform_params.
+        '''
+        if not self.transform_params:
+            return str(self.transform_key)
+        return f'{self.transform_key}:{json.dumps(dict(self.transform_params), sort_keys=True)}'
 
-            queue.append((filename, url))
-        self._download(queue)
-        queue.clear()
+    def _begin_run(self) -> None:
+        '''
+        Starts or resumes the journaled run. Images that were started but not
+        finished by an interrupted run are removed, since they may be partial.
+        '''
+        self.results.clear()
+        self._journaled = set()
+        self._run_started = time.time()
+        for filename, (state, detail) in self.journal.begin('download').items():
+            image = self.out_dir / filename
+            if state == 'done' and image.exists() and image.stat().st_size == detail['size']:
+                self._journaled.add(filename)
+            elif state != 'failed' and image.exists():
+                print(f'Image {filename} may be partial, downloading it again')
+                image.unlink()
+                self.existing_images.discard(filename)
+        if self._journaled:
+            print(f'Resuming an interrupted run, {len(self._journaled)} images are already done')
 
+    def _end_run(self, completed: bool) -> None:
+        if completed:
+            self.journal.end('download')
+        else:
+            self.journal.flush()
+        if self.resources is None:
+            # With shared resources the store is evicted once they're closed
+            self.store.evict(keep_since=self._run_started)
 
-    def _download(self, chunk: list[tuple[str, str]]) -> None:
-        if not chunk:
+    def _start_transform_stage(self) -> None:
+        if self._transform_pool is not None:
             return
-        threads = [threading.Thread(target=self._download_item, args=(item,)) for item in chunk]
-        for thread in threads:
-            thread.start()
-        for thread in threads:
-            thread.join()
-
-    def _download_item(self, item: tuple[str, str]):
-        filename, url = item
-        if filename in self.existing_images:
-            print(f'Image {filename} already exists')
+        if self.resources is not None:
+            self._transform_pool = self.resources.transform_pool
+            self._transform_slots = self.resources.transform_slots
+            return
+        if self.transform_processes == 0:
+            return
+        self._transform_pool = ProcessPoolExecutor(
+            max_workers=self.transform_processes,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        self._transform_slots = threading.BoundedSemaphore(self.transform_processes * 2)
+
+    def _stop_transform_stage(self) -> None:
+        if self._transform_pool is not None:
+            if self.resources is None:
+                self._transform_pool.shutdown(wait=True)
+            else:
+                # Only wait for this downloader's images, the pool is shared
+                with self._active_changed:
+                    while self._transforming:
+                        self._active_changed.wait()
+            self._transform_pool = None
+            self._transform_slots = None
+
+    def _worker(self, queue: Queue) -> None:
+        while (item := queue.get()) is not None:
+            try:
+                self._download_item(item)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                print(f'Unexpected error while downloading {item[1]}: {e}')
+            finally:
+                self._track(-1)
+
+    def _track(self, change: int) -> None:
+        with self._active_changed:
+            self._active += change
+            self._active_changed.notify_all()
+
+    def _download_item(self, item: tuple[str, str, int]):
+        filename, url, attempt = item
+        conditional = self._conditional_headers(filename, url)
+        if conditional is None:
+            return
+        self.journal.record('download', filename, 'started')
+
+        with self._url_lock(url):
+            if filename not in self.existing_images and self._reuse_stored(filename, url):
+                return
+            self._fetch_item(filename, url, conditional, attempt)
+
+    @contextmanager
+    def _url_lock(self, url: str):
+        with self._locks_guard:
+            lock = self._url_locks.setdefault(url, threading.Lock())
+        with lock:
+            yield
+
+    def _fetch_item(self, filename: str, url: str, conditional: dict[str, str],
+                    attempt: int = 1) -> None:
+        log = self._new_log(filename, url)
+        log['attempts'] = attempt
+        headers = {}
+        spool = None
+        stale = False
+        self.retry_policy.request()
+        try:
+            with self.http.stream(url, headers={**self.headers, **conditional}) as resp:
+                headers = resp.headers
+                log['status_code'] = resp.status_code
+                log['reason'] = resp.reason
+                if resp.status_code == 304:
+                    if self._not_modified(filename, url):
+                        return
+                    stale = True
+                else:
+                    resp.raise_for_status()
+                    spool = self._new_spool(headers.get('Content-Length'))
+                    for chunk in resp.iter_content(self.chunk_size):
+                        spool.write(chunk)
+                    spool.close()
+                    log['success'] = True
+        except requests.Timeout as e:
+            log['timeout'] = True
+            log['reason'] = str(e)
+        except requests.HTTPError:
+            pass
+        except (requests.RequestException, ImageTooLarge) as e:
+            log['reason'] = str(e)
+
+        if stale:
+            # The stored image the request asked about is gone since
+            self._fetch_item(filename, url, {}, attempt)
             return
+        if log['success'] and spool is not None:
+            self.validators.put(filename, url, headers)
+            self._submit_image(spool, log, headers)
+            return
+        if spool is not None:
+            spool.release()
+        delay = self._retry_or_fail(log, parse_retry_after(headers.get('Retry-After')))
+        if delay is not None and self._retries is not None:
+            self._track(1)
+            self._retries.schedule(delay, (filename, url, attempt + 1))
+
+    def _retry_or_fail(self, log: dict, retry_after: float | None = None) -> float | None:
+        '''
+        Returns how long to wait before retrying the image of log,
+        or records it as failed and returns None.
+        '''
+        kind = error_class(log['status_code'], log['timeout'])
+        delay = self.retry_policy.delay(kind, log['attempts'], retry_after)
+        if delay is None:
+            self._save_failure(log)
+            return None
+        print(f"Retrying {log['url']} in {delay:.1f}s after {kind} error, attempt {log['attempts']}")
+        return delay
+
+    def _conditional_headers(self, filename: str, url: str) -> dict[str, str] | None:
+        '''
+        The extra headers for requesting the image, or None if the image was
+        finished by the resumed run or already exists and can't be revalidated.
+        '''
+        if filename in self._journaled:
+            return None
+        if filename not in self.existing_images:
+            return self._stored_validators(filename, url)
+        headers = self.validators.headers_for(filename, url)
+        if headers is None:
+            print(f'Image {filename} already exists')
+        return headers
+
+    def _not_modified(self, filename: str, url: str) -> bool:
+        '''
+        Keeps the image after a 304 answer. An image that isn't in the images
+        directory was asked about with the validators of the store, and is linked
+        from there. Returns False if the store no longer has it.
+        '''
+        if filename not in self.existing_images:
+            return self._reuse_stored(filename, url, revalidated=True)
+        self.validators.touch(filename)
+        # Otherwise a resumed run would take the kept image for a partial one
+        self.journal.record('download', filename, 'done',
+                            size=(self.out_dir / filename).stat().st_size)
+        print(f'Image {filename} not modified')
+        return True
 
+    def _new_log(self, filename: str, url: str) -> dict:
         log = {}
         log['success'] = False
         log['filename'] = filename
@@ -75,28 +428,182 @@ class ImageDownloader:
         log['status_code'] = None
         log['timeout'] = False
         log['reason'] = 'Ok'
+        log['attempts'] = 1
+        return log
+
+    def _stored_validators(self, filename: str, url: str) -> dict[str, str]:
+        '''
+        The headers asking the server whether the image the store has for url
+        changed. Empty if the store has none for this transformation.
+        '''
+        known = self.store.lookup_url(url)
+        if known is None:
+            return {}
+        digest, headers, _ = known
+        path = self.store.object_path(digest, self.transform_id, self._extension(filename))
+        with self._locks_guard:
+            if not (path.exists() or path in self._pending_objects):
+                return {}
+        return conditional_headers(headers)
+
+    def _reuse_stored(self, filename: str, url: str, revalidated: bool = False) -> bool:
+        '''
+        Links the image from the store without a request, if its URL was
+        downloaded by this run or within the store's url_max_age. With
+        revalidated set, the server answered that it didn't change.
+        '''
+        known = self.store.lookup_url(url)
+        if known is None:
+            return False
+        digest, headers, fetched = known
+        if not (revalidated or fetched >= self._run_started or self.store.is_fresh(fetched)):
+            return False
+        path = self.store.object_path(digest, self.transform_id, self._extension(filename))
+        log = self._new_log(filename, url)
+        log['success'] = True
+        log['status_code'] = 304 if revalidated else None
+        log['reason'] = 'Not modified, reused from the image store' if revalidated \
+                        else 'Reused from the image store'
+        if not self._attach(path, log, reserve=False):
+            return False
+        if revalidated:
+            self.store.record_url(url, digest, headers)
+        self.validators.put(filename, url, headers)
+        return True
+
+    def _attach(self, path: pathlib.Path, log: dict, reserve: bool) -> bool:
+        '''
+        Links the image of log to a stored object, or waits for it if it is still
+        being transformed. Returns False if the object doesn't exist. With reserve
+        set, the caller is then expected to create it.
+        '''
+        with self._locks_guard:
+            if path in self._pending_objects:
+                self._pending_objects[path].append(log)
+                return True
+            if not path.exists():
+                if reserve:
+                    self._pending_objects[path] = []
+                return False
+        materialize(path, self.out_dir / log['filename'])
+        self.store.touch_object(path)
+        self._completed(log)
+        print(log)
+        return True
+
+    def _new_spool(self, content_length: str | int | None) -> Spool:
+        '''
+        A spool for an image of content_length bytes. Waits for room in the byte budget.
+        '''
         try:
-            resp = requests.get(url, headers=self.headers, timeout=10)
-            log['status_code'] = resp.status_code
-            log['reason'] = resp.reason
-            resp.raise_for_status()
-            log['success'] = True
-        except requests.Timeout as e:
-            e.add_note('time out')
-            log['timeout'] = True
-        except requests.HTTPError as e:
-            e.add_note('http error')
+            expected = int(content_length) if content_length is not None else None
+        except ValueError:
+            expected = None
+        spool = Spool(self.store.spool_dir, self.max_image_size, self.budget)
+        try:
+            spool.reserve(expected)
+        except BaseException:
+            spool.release()
+            raise
+        return spool
+
+    def _submit_image(self, spool: Spool, log: dict, headers) -> None:
+        '''
+        Hands the downloaded image to the transform stage, unless an identical image
+        is already in the store. Blocks while the processes already have a full
+        backlog, so downloads can't outrun them. The spool is released once the
+        image is transformed.
+        '''
+        self.store.record_url(log['url'], spool.digest, headers)
+        path = self.store.object_path(spool.digest, self.transform_id,
+                                      self._extension(log['filename']))
+        if self._attach(path, log, reserve=True):
+            spool.release()
+            return
+
+        if self._transform_pool is None or self._transform_slots is None:
+            try:
+                self._save_image(spool.path, log, path)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                self._finish_object(path, log, e)
+                return
+            finally:
+                spool.release()
+            self._finish_object(path, log, None)
+            return
+
+        self._transform_slots.acquire()
+        self._track_transform(1)
+        try:
+            future = self._transform_pool.submit(self._save_image, spool.path, log, path)
+        except BaseException as e:
+            self._transform_slots.release()
+            self._track_transform(-1)
+            spool.release()
+            self._finish_object(path, log, e)
+            raise
+        future.add_done_callback(partial(self._transform_done, log, path, spool))
+
+    def _transform_done(self, log: dict, path: pathlib.Path, spool: Spool, future: Future) -> None:
+        if self._transform_slots is not None:
+            self._transform_slots.release()
+        spool.release()
+        try:
+            self._finish_object(path, log, future.exception())
         finally:
-            if log['success']:
-                out_path = self.out_dir / filename
-                with out_path.open('wb') as f:
-                    f.write(self.transform_image(resp.content, filename))
-                print(log)
-            else:
-                failed_image = self.out_dir / f"{'Failed_log'}-{filename}.txt"
-                with failed_image.open('w') as log_file:
-                    log_file.write(pprint.pformat(log))
-                print(f"Failed to download image {url}. Check {str(failed_image)} for info")
+            self._track_transform(-1)
+
+    def _track_transform(self, change: int) -> None:
+        with self._active_changed:
+            self._transforming += change
+            self._active_changed.notify_all()
+
+    def _finish_object(self, path: pathlib.Path, log: dict, error: BaseException | None) -> None:
+        with self._locks_guard:
+            waiting = self._pending_objects.pop(path, [])
+        if error is not None:
+            for item in [log, *waiting]:
+                self.validators.remove(item['filename'])
+                self.results.record({**item, 'success': False,
+                                     'reason': f'Failed to transform: {error}'})
+                self.journal.record('download', item['filename'], 'failed')
+                print(f"Failed to transform image {item['filename']}: {error}")
+            return
+        self.store.touch_object(path)
+        self._completed(log)
+        for item in waiting:
+            materialize(path, self.out_dir / item['filename'])
+            self._completed(item)
+            print(item)
+
+    def _completed(self, log: dict) -> None:
+        image = self.out_dir / log['filename']
+        size = image.stat().st_size
+        if self.verify_images:
+            self.verified.add(image)
+        self.results.record(log)
+        self.journal.record('download', log['filename'], 'done', size=size)
+        if self.on_image is not None:
+            self.on_image(image)
+
+    def _save_image(self, source: pathlib.Path, log: dict, path: pathlib.Path) -> None:
+        filename = log['filename']
+        transformed = self.transform_image(source.read_bytes(), filename)
+        if self.verify_images:
+            check_image(transformed)
+        write_object(path, transformed)
+        materialize(path, self.out_dir / filename)
+        print(log)
+
+    @staticmethod
+    def _extension(filename: str) -> str:
+        return filename.rsplit('.', maxsplit=1)[-1].lower()
+
+    def _save_failure(self, log: dict) -> None:
+        self.results.record(log)
+        self.journal.record('download', log['filename'], 'failed')
+        print(f"Failed to download image {log['url']} after {log['attempts']} attempts. "
+              f"Check {self.results.path.name} for info")
 
     @abstractmethod
     def transform_image(self, image: bytes, filename: str) -> bytes:
@@ -2,12 +2,15 @@
 Functions that manage exporting images through the rest API.
 """
 
-# import pathlib
-# import zipfile
-# import io
+import pathlib
+from collections.abc import Iterator
 
 
-def export_images():
+def export_images(archive: pathlib.Path, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
     '''
-    Serializes the file for serving.
+    Serializes the file for serving. Yields the archive in chunks of
+    chunk_size bytes, so it's never held in memory whole.
     '''
+    with archive.open('rb') as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
@@ -0,0 +1,213 @@
+'''
+Content addressed store for transformed images, shared between suppliers.
+'''
+
+import hashlib
+import os
+import pathlib
+import shutil
+import sqlite3
+import threading
+import time
+
+
+class ImageStore:
+    '''
+    Keeps one transformed copy of every unique image and hardlinks it under
+    every filename that needs it.
+
+    Images are addressed by the sha256 of the downloaded bytes together with a
+    transform key, which names the transformation applied to them. An index maps
+    every image URL to the hash of its content and its validators, so a URL that
+    was already downloaded, by any supplier, is only revalidated with a
+    conditional request. Set url_max_age to skip even that for the URLs fetched
+    in the last url_max_age seconds, at the risk of missing an image replaced
+    under the same URL.
+
+    Downloads in progress are spooled to files in the tmp directory of the
+    store instead of being held in memory.
+
+    The store lives next to the supplier directories by default, so all the
+    suppliers share it. Hardlinks need the store and the images directories to be
+    on the same filesystem, otherwise the files are copied.
+
+    Every use of an object is recorded, and evict() deletes the least recently
+    used objects until the store fits max_size bytes. It runs once a run is
+    over, or once every downloader sharing a SharedResources is done. Images
+    already linked into an images directory are not affected. Pass None to keep
+    everything.
+    '''
+
+    def __init__(self, root: pathlib.Path,
+                 url_max_age: float | None = None,
+                 max_size: int | None = 10 * 1024 ** 3):
+        self.root = root
+        self.max_size = max_size
+        self.objects = root / 'objects'
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.spool_dir = root / 'tmp'
+        self.spool_dir.mkdir(exist_ok=True)
+        for leftover in self.spool_dir.iterdir():
+            # Spools of crashed runs
+            if time.time() - leftover.stat().st_mtime > 24 * 3600:
+                leftover.unlink(missing_ok=True)
+        self.url_max_age = url_max_age
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(root / 'index.sqlite'), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                '''CREATE TABLE IF NOT EXISTS urls (
+                       url TEXT PRIMARY KEY,
+                       hash TEXT,
+                       etag TEXT,
+                       last_modified TEXT,
+                       fetched REAL
+                   )'''
+            )
+            self.connection.execute(
+                '''CREATE TABLE IF NOT EXISTS objects (
+                       path TEXT PRIMARY KEY,
+                       size INTEGER,
+                       used REAL
+                   )'''
+            )
+
+    def lookup_url(self, url: str) -> tuple[str, dict[str, str], float] | None:
+        '''
+        Returns the content hash, the validator headers and the time of the last
+        download or revalidation of a known url.
+        '''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT hash, etag, last_modified, fetched FROM urls WHERE url = ?', (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        digest, etag, last_modified, fetched = row
+        headers = {}
+        if etag:
+            headers['ETag'] = etag
+        if last_modified:
+            headers['Last-Modified'] = last_modified
+        return digest, headers, fetched
+
+    def is_fresh(self, fetched: float) -> bool:
+        '''
+        Whether a url fetched at fetched can be reused without asking the server.
+        '''
+        return self.url_max_age is not None and time.time() - fetched <= self.url_max_age
+
+    def record_url(self, url: str, digest: str, headers) -> None:
+        '''
+        Remembers the content hash and validators of url.
+        '''
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?)',
+                (url, digest, headers.get('ETag'), headers.get('Last-Modified'), time.time())
+            )
+
+    def forget_url(self, url: str) -> None:
+        '''
+        Drops url from the index.
+        '''
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM urls WHERE url = ?', (url,))
+
+    def object_path(self, digest: str, transform_key: str, ext: str) -> pathlib.Path:
+        '''
+        Where the transformed image for digest is kept.
+        '''
+        key = hashlib.sha256(transform_key.encode()).hexdigest()[:12]
+        return self.objects / digest[:2] / f'{digest}-{key}.{ext}'
+
+    def touch_object(self, path: pathlib.Path) -> None:
+        '''
+        Records that the object at path was just created or used.
+        '''
+        name = path.relative_to(self.objects).as_posix()
+        size = path.stat().st_size
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?)', (name, size, time.time())
+            )
+
+    def evict(self, keep_since: float | None = None) -> None:
+        '''
+        Deletes the least recently used objects until the store fits max_size.
+        Objects made before their use was recorded count as used when they were written.
+        Objects used at or after keep_since, a time.time(), are always kept, so
+        a run never evicts what it used itself.
+        '''
+        if self.max_size is None:
+            return
+        with self.lock:
+            known = {name for name, in self.connection.execute('SELECT path FROM objects')}
+        found = []
+        for file in self.objects.glob('*/*'):
+            name = file.relative_to(self.objects).as_posix()
+            if name not in known and not file.name.endswith('.tmp'):
+                stat = file.stat()
+                found.append((name, stat.st_size, stat.st_mtime))
+
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO objects VALUES (?, ?, ?)', found)
+            rows = self.connection.execute(
+                'SELECT path, size, used FROM objects ORDER BY used DESC'
+            ).fetchall()
+
+        total = 0
+        evicted = []
+        for name, size, used in rows:
+            total += size
+            if total > self.max_size and (keep_since is None or used < keep_since):
+                (self.objects / name).unlink(missing_ok=True)
+                evicted.append((name,))
+        if evicted:
+            with self.lock, self.connection:
+                self.connection.executemany('DELETE FROM objects WHERE path = ?', evicted)
+            print(f'Evicted {len(evicted)} images from the image store')
+
+    def close(self) -> None:
+        '''
+        Closes the index.
+        '''
+        with self.lock:
+            self.connection.close()
+
+
+def content_hash(content: bytes) -> str:
+    '''
+    The address of content in the store.
+    '''
+    return hashlib.sha256(content).hexdigest()
+
+
+def write_object(path: pathlib.Path, content: bytes) -> None:
+    '''
+    Writes a store object. The file is renamed into place,
+    so a reader never sees a partial object.
+    '''
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with tmp.open('wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def materialize(source: pathlib.Path, target: pathlib.Path) -> None:
+    '''
+    Makes target a hardlink of the store object source, or a copy if
+    hardlinks aren't possible. The link or copy is made under a temporary
+    name and renamed over target, so target is never partial.
+    '''
+    tmp = target.with_name(f'.{target.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, target)
+    # rename does nothing if target already was a link to source
+    tmp.unlink(missing_ok=True)
@@ -0,0 +1,600 @@
+'''
+Local job service. Clients submit supplier jobs over HTTP, poll their progress,
+follow their logs and download their archives.
+'''
+
+import json
+import os
+import pathlib
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from .exports import export_images
+from .orchestrator import check_job, run_job, suppliers_path
+from .resources import SharedResources
+from .utils import run_progress
+from ..suppliers import SUPPLIERS_ENV
+
+package_root = pathlib.Path(__file__).parent.parent.parent
+
+
+class QueueFull(Exception):
+    '''
+    Raised when a job is submitted while the queue, or the client's share of it, is full.
+    '''
+
+
+class JobQueue:
+    '''
+    Persistent queue of jobs in a SQLite file. A job goes from queued to running
+    and then to done, failed or cancelled. Jobs left running by a service that
+    stopped are queued again when the queue is opened, and the supplier's
+    journal resumes them where they stopped.
+
+    At most max_queued jobs wait at once, and at most max_queued_per_client of
+    one client, so a single client can't fill the queue. claim() hands out the
+    oldest job of the client with the fewest running jobs, so clients take turns,
+    and never a job of a supplier that is already running, since they would
+    share its directory.
+    '''
+
+    columns = ('id', 'client', 'job', 'state', 'error', 'submitted', 'started', 'finished')
+
+    def __init__(self, path: pathlib.Path, max_queued: int = 100, max_queued_per_client: int = 10):
+        self.path = path
+        self.max_queued = max_queued
+        self.max_queued_per_client = max_queued_per_client
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                '''CREATE TABLE IF NOT EXISTS jobs (
+                       id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       client TEXT,
+                       job TEXT,
+                       state TEXT,
+                       error TEXT,
+                       submitted REAL,
+                       started REAL,
+                       finished REAL
+                   )'''
+            )
+            self.connection.execute(
+                "UPDATE jobs SET state = 'queued', started = NULL WHERE state = 'running'"
+            )
+
+    def submit(self, job: dict, client: str) -> int:
+        '''
+        Queues job for client and returns its id. Raises QueueFull if there's no room.
+        '''
+        with self.lock, self.connection:
+            queued, mine = self.connection.execute(
+                "SELECT COUNT(*), COUNT(CASE WHEN client = ? THEN 1 END) FROM jobs WHERE state = 'queued'",
+                (client,)
+            ).fetchone()
+            if queued >= self.max_queued:
+                raise QueueFull(f'The queue is full, {queued} jobs are waiting')
+            if mine >= self.max_queued_per_client:
+                raise QueueFull(f'{mine} jobs of {client} are waiting already')
+            cursor = self.connection.execute(
+                "INSERT INTO jobs (client, job, state, submitted) VALUES (?, ?, 'queued', ?)",
+                (client, json.dumps(job), time.time())
+            )
+            return int(cursor.lastrowid) # type: ignore
+
+    def claim(self) -> dict | None:
+        '''
+        Marks the next job to run as running and returns it, or None if no job can run now.
+        '''
+        with self.lock, self.connection:
+            running = self.connection.execute(
+                "SELECT client, job FROM jobs WHERE state = 'running'"
+            ).fetchall()
+            busy = {json.loads(job)['supplier'] for _, job in running}
+            per_client: dict[str, int] = {}
+            for client, _ in running:
+                per_client[client] = per_client.get(client, 0) + 1
+            candidates = [
+                (per_client.get(client, 0), job_id)
+                for job_id, client, job in self.connection.execute(
+                    "SELECT id, client, job FROM jobs WHERE state = 'queued' ORDER BY id"
+                )
+                if json.loads(job)['supplier'] not in busy
+            ]
+            if not candidates:
+                return None
+            _, job_id = min(candidates)
+            self.connection.execute(
+                "UPDATE jobs SET state = 'running', started = ? WHERE id = ?", (time.time(), job_id)
+            )
+        return self.get(job_id)
+
+    def finish(self, job_id: int, state: str, error: str | None = None) -> None:
+        '''
+        Records how a running job ended, 'done', 'failed' or 'cancelled',
+        or puts it back in the queue with 'queued'.
+        '''
+        finished = None if state == 'queued' else time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE jobs SET state = ?, error = ?, finished = ? WHERE id = ?',
+                (state, error, finished, job_id)
+            )
+
+    def cancel(self, job_id: int) -> bool:
+        '''
+        Cancels a queued job. Returns whether it was queued.
+        '''
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "UPDATE jobs SET state = 'cancelled', finished = ? WHERE id = ? AND state = 'queued'",
+                (time.time(), job_id)
+            )
+            return cursor.rowcount == 1
+
+    def get(self, job_id: int) -> dict | None:
+        '''
+        The job with job_id, or None.
+        '''
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return None if row is None else self._job(row)
+
+    def jobs(self) -> list[dict]:
+        '''
+        Every job, oldest first.
+        '''
+        with self.lock:
+            rows = self.connection.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+        return [self._job(row) for row in rows]
+
+    def close(self) -> None:
+        '''
+        Closes the database connection.
+        '''
+        with self.lock:
+            self.connection.close()
+
+    def _job(self, row: tuple) -> dict:
+        job = dict(zip(self.columns, row))
+        job['job'] = json.loads(job['job'])
+        return job
+
+
+class JobService:
+    '''
+    Runs the jobs of a JobQueue in data_dir on a bounded pool of workers
+    threads. Every job runs in a process of its own, with data_dir/jobs/<id> as
+    its working directory. Its output goes to log.txt there and its archives are
+    written there. Each job gets transform_processes processes, by default the
+    cores split between the workers, so running jobs don't compete for the cores.
+
+    A job is what the orchestrator takes, see orchestrator.check_job, and needs
+    a file. Relative paths are resolved against the working directory of the
+    service.
+
+    The suppliers are looked up in suppliers_dir, the suppliers of the package by
+    default, and keep their data there. Their names must differ from those of
+    the package's suppliers. store_root is where the jobs keep the image store,
+    by default next to the suppliers.
+    '''
+
+    def __init__(self, data_dir: pathlib.Path,
+                 workers: int = 2,
+                 max_queued: int = 100,
+                 max_queued_per_client: int = 10,
+                 transform_processes: int | None = None,
+                 suppliers_dir: pathlib.Path = suppliers_path,
+                 store_root: pathlib.Path | None = None):
+        data_dir.mkdir(parents=True, exist_ok=True)
+        self.data_dir = data_dir
+        self.suppliers_dir = suppliers_dir.absolute()
+        self.store_root = store_root.absolute() if store_root is not None else None
+        self.jobs_dir = data_dir / 'jobs'
+        self.uploads_dir = data_dir / 'uploads'
+        self.queue = JobQueue(data_dir / 'jobs.sqlite', max_queued, max_queued_per_client)
+        self.workers = max(1, workers)
+        if transform_processes is None:
+            transform_processes = max(1, (os.cpu_count() or 1) // self.workers)
+        self.transform_processes = transform_processes
+        self.processes: dict[int, subprocess.Popen] = {}
+        self.cancelled: set[int] = set()
+        self.changed = threading.Condition()
+        self.stopping = False
+        self._threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        '''
+        Starts the workers.
+        '''
+        self.stopping = False
+        self._threads = [threading.Thread(target=self._worker, daemon=True)
+                         for _ in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        '''
+        Stops the workers. Running jobs are stopped and queued again.
+        '''
+        with self.changed:
+            self.stopping = True
+            for process in self.processes.values():
+                process.terminate()
+            self.changed.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, job: dict, client: str) -> int:
+        '''
+        Queues job and returns its id. Raises ValueError for an invalid job
+        and QueueFull if there's no room for it.
+        '''
+        check_job(job, self.suppliers_dir)
+        if not job.get('file'):
+            raise ValueError('A job of the service needs a file')
+        job = {**job, 'file': str(pathlib.Path(job['file']).absolute())}
+        if not pathlib.Path(job['file']).is_file():
+            raise ValueError(f"No file {job['file']}")
+        job_id = self.queue.submit(job, client)
+        with self.changed:
+            self.changed.notify_all()
+        return job_id
+
+    def upload_path(self, filename: str) -> pathlib.Path:
+        '''
+        Where to keep a file uploaded with a job. The name keeps its extension.
+        '''
+        self.uploads_dir.mkdir(exist_ok=True)
+        return self.uploads_dir.absolute() / f'{uuid.uuid4().hex}-{pathlib.Path(filename).name}'
+
+    def remove_upload(self, job: dict) -> None:
+        '''
+        Deletes the file of job if it was uploaded.
+        '''
+        if not job.get('file'):
+            return
+        file = pathlib.Path(job['file'])
+        if file.parent == self.uploads_dir.absolute():
+            file.unlink(missing_ok=True)
+
+    def cancel(self, job_id: int) -> bool:
+        '''
+        Cancels a queued or running job. Returns False if it had already ended.
+        '''
+        if self.queue.cancel(job_id):
+            self.remove_upload(self.queue.get(job_id)['job']) # type: ignore
+            return True
+        with self.changed:
+            process = self.processes.get(job_id)
+            if process is None:
+                return False
+            self.cancelled.add(job_id)
+            process.terminate()
+        return True
+
+    def status(self, job_id: int, progress: bool = True) -> dict | None:
+        '''
+        The job with its state, the names of its archives and, if progress is
+        set, the progress of its supplier while it runs.
+        '''
+        job = self.queue.get(job_id)
+        if job is None:
+            return None
+        options = job.pop('job')
+        job.update(options)
+        job_dir = self.jobs_dir / str(job_id)
+        job['archives'] = sorted(archive.name for archive in job_dir.glob('*.zip')) \
+                          if job['state'] == 'done' else []
+        if progress and job['state'] == 'running':
+            job['progress'] = run_progress(self.suppliers_dir / job['supplier'])
+        return job
+
+    def log_path(self, job_id: int) -> pathlib.Path:
+        '''
+        The output of the job.
+        '''
+        return self.jobs_dir / str(job_id) / 'log.txt'
+
+    def archive_path(self, job_id: int, name: str | None = None) -> pathlib.Path | None:
+        '''
+        The archive called name of a finished job, or its first archive. None if there's none.
+        '''
+        job = self.status(job_id, progress=False)
+        if job is None or not job['archives']:
+            return None
+        if name is None:
+            name = job['archives'][0]
+        if name not in job['archives']:
+            return None
+        return self.jobs_dir / str(job_id) / name
+
+    def _worker(self) -> None:
+        while True:
+            with self.changed:
+                if self.stopping:
+                    return
+                job = self.queue.claim()
+                if job is None:
+                    self.changed.wait(timeout=1)
+                    continue
+            try:
+                state, error = self._run(job)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                state, error = 'failed', f'{type(e).__name__}: {e}'
+            self.queue.finish(job['id'], state, error)
+            if state != 'queued':
+                self.remove_upload(job['job'])
+            with self.changed:
+                self.changed.notify_all()
+
+    def _run(self, job: dict) -> tuple[str, str | None]:
+        job_dir = self.jobs_dir / str(job['id'])
+        job_dir.mkdir(parents=True, exist_ok=True)
+        (job_dir / 'job.json').write_text(json.dumps(job['job']), encoding='utf8')
+        env = {**os.environ, 'PYTHONUNBUFFERED': '1',
+               'PYTHONPATH': os.pathsep.join(filter(None, [str(package_root),
+                                                           os.environ.get('PYTHONPATH')]))}
+        if self.suppliers_dir != suppliers_path.absolute():
+            env[SUPPLIERS_ENV] = str(self.suppliers_dir)
+        with self.log_path(job['id']).open('ab') as log:
+            with self.changed:
+                if self.stopping:
+                    return 'queued', None
+                process = subprocess.Popen( # pylint: disable=consider-using-with
+                    [sys.executable, '-m', 'Image_Downloader.backend.jobservice',
+                     'job.json', str(self.transform_processes), str(self.store_root or '')],
+                    cwd=job_dir, stdout=log, stderr=subprocess.STDOUT, env=env
+                )
+                self.processes[job['id']] = process
+            code = process.wait()
+        with self.changed:
+            del self.processes[job['id']]
+            if job['id'] in self.cancelled:
+                self.cancelled.discard(job['id'])
+                return 'cancelled', None
+            if self.stopping:
+                return 'queued', None
+        if code != 0:
+            return 'failed', f'The job exited with code {code}, see its logs'
+        return 'done', None
+
+
+class JobServer(ThreadingHTTPServer):
+    '''
+    The HTTP server of a JobService.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], service: JobService):
+        super().__init__(address, JobRequestHandler)
+        self.service = service
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    '''
+    The HTTP API of the job service:
+
+    POST /jobs                  submits a job. The body is the job as JSON, or
+                                the catalog file itself, with the job options in
+                                the query and its name in filename, e.g.
+                                /jobs?supplier=kentia&filename=kentia.xlsx&engine=async
+                                Answers 201 with the id, or 429 if the queue is full.
+                                An empty upload, or one cut short of its
+                                Content-Length, answers 400 and isn't kept.
+    GET /jobs                   lists the jobs.
+    GET /jobs/<id>              the job, with its progress while it runs.
+    GET /jobs/<id>/logs         the output of the job, followed until it ends
+                                unless follow=0 is passed.
+    GET /jobs/<id>/archive      the archive of a finished job, or the archive
+                                named volume=<name> if it has more.
+    DELETE /jobs/<id>           cancels the job.
+
+    Clients identify themselves with an X-Client-Id header, or by their address.
+    '''
+
+    server: JobServer
+    max_upload_size = 512 * 1024 ** 2
+    max_json_size = 1024 ** 2
+    retry_after = 30
+    follow_interval = 0.5
+
+    def do_POST(self): # pylint: disable=invalid-name
+        '''
+        Submits a job.
+        '''
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != '/jobs':
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': 'Not found'})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        client = self.headers.get('X-Client-Id') or self.client_address[0]
+        service = self.server.service
+        job: dict = {}
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                if length > self.max_json_size:
+                    raise ValueError('The job is too large')
+                job = json.loads(self.rfile.read(length))
+                if not isinstance(job, dict):
+                    raise ValueError('The job must be a JSON object')
+            else:
+                job = self._upload(url.query, length)
+            job_id = service.submit(job, client)
+        except QueueFull as e:
+            service.remove_upload(job)
+            self._send_json(HTTPStatus.TOO_MANY_REQUESTS, {'error': str(e)},
+                            {'Retry-After': str(self.retry_after)})
+            return
+        except ValueError as e:
+            service.remove_upload(job)
+            self._send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+            return
+        self._send_json(HTTPStatus.CREATED, {'id': job_id}, {'Location': f'/jobs/{job_id}'})
+
+    def do_GET(self): # pylint: disable=invalid-name
+        '''
+        Answers the status, logs and archive requests.
+        '''
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')
+        service = self.server.service
+        if parts == ['jobs']:
+            self._send_json(HTTPStatus.OK, [service.status(job['id'], progress=False)
+                                            for job in service.queue.jobs()])
+            return
+        job_id = self._job_id(parts)
+        if job_id is None:
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': 'Not found'})
+            return
+        if len(parts) == 2:
+            self._send_json(HTTPStatus.OK, service.status(job_id))
+        elif parts[2] == 'logs':
+            self._send_logs(job_id, query.get('follow', '1') != '0')
+        elif parts[2] == 'archive':
+            archive = service.archive_path(job_id, query.get('volume'))
+            if archive is None:
+                self._send_json(HTTPStatus.NOT_FOUND, {'error': 'The job has no such archive'})
+                return
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', 'application/zip')
+            self.send_header('Content-Length', str(archive.stat().st_size))
+            self.send_header('Content-Disposition', f'attachment; filename="{archive.name}"')
+            self.end_headers()
+            for chunk in export_images(archive):
+                self.wfile.write(chunk)
+        else:
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': 'Not found'})
+
+    def do_DELETE(self): # pylint: disable=invalid-name
+        '''
+        Cancels a job.
+        '''
+        parts = urlparse(self.path).path.strip('/').split('/')
+        job_id = self._job_id(parts)
+        if job_id is None or len(parts) != 2:
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': 'Not found'})
+            return
+        if not self.server.service.cancel(job_id):
+            self._send_json(HTTPStatus.CONFLICT, {'error': 'The job has already ended'})
+            return
+        self._send_json(HTTPStatus.OK, {'id': job_id, 'cancelled': True})
+
+    def _job_id(self, parts: list[str]) -> int | None:
+        if len(parts) < 2 or parts[0] != 'jobs' or not parts[1].isdigit():
+            return None
+        job_id = int(parts[1])
+        return job_id if self.server.service.queue.get(job_id) is not None else None
+
+    def _upload(self, query: str, length: int) -> dict:
+        '''
+        Saves the uploaded catalog and returns the job from the query.
+        '''
+        options = {key: values[-1] for key, values in parse_qs(query).items()}
+        filename = options.pop('filename', None)
+        if not filename:
+            raise ValueError('An uploaded file needs a filename')
+        if length <= 0:
+            raise ValueError('The upload is empty, send the file with its Content-Length')
+        if length > self.max_upload_size:
+            raise ValueError(f'The file is larger than {self.max_upload_size} bytes')
+        job: dict = dict(options)
+        for flag in ('stream', 'incremental'):
+            if flag in job:
+                job[flag] = job[flag].lower() in ('1', 'true', 'yes')
+        check_job(job, self.server.service.suppliers_dir)
+        path = self.server.service.upload_path(filename)
+        try:
+            with path.open('wb') as f:
+                remaining = length
+                while remaining:
+                    chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if remaining:
+                raise ValueError(f'The upload ended {remaining} bytes short of its Content-Length')
+        except (ValueError, OSError):
+            # The caller only knows about the file once the job is returned
+            path.unlink(missing_ok=True)
+            raise
+        job['file'] = str(path)
+        return job
+
+    def _send_logs(self, job_id: int, follow: bool) -> None:
+        '''
+        Sends the log, and with follow keeps sending what the job writes until it
+        ends. The response has no length, it ends when the connection closes.
+        '''
+        service = self.server.service
+        log = service.log_path(job_id)
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.end_headers()
+        position = 0
+        while True:
+            running = service.queue.get(job_id)['state'] in ('queued', 'running') # type: ignore
+            if log.exists():
+                with log.open('rb') as f:
+                    f.seek(position)
+                    for chunk in iter(lambda: f.read(64 * 1024), b''):
+                        self.wfile.write(chunk)
+                        position += len(chunk)
+                self.wfile.flush()
+            if not follow or not running:
+                return
+            time.sleep(self.follow_interval)
+
+    def _send_json(self, status: HTTPStatus, body, headers: dict[str, str] | None = None) -> None:
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def serve(data_dir: pathlib.Path, host: str = '127.0.0.1', port: int = 8080, **options) -> None:
+    '''
+    Runs the job service until interrupted. options are passed to JobService.
+    '''
+    service = JobService(data_dir, **options)
+    service.start()
+    server = JobServer((host, port), service)
+    print(f'Serving jobs on http://{host}:{port}/jobs, data in {data_dir}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        service.queue.close()
+
+
+if __name__ == '__main__':
+    # A job, started by JobService in its own process
+    job_file, processes = pathlib.Path(sys.argv[1]), int(sys.argv[2])
+    job_store = sys.argv[3]
+    # The suppliers read their file from argv when they aren't given one
+    sys.argv = sys.argv[:1]
+    resources = SharedResources(transform_processes=processes,
+                                store_root=pathlib.Path(job_store) if job_store else None)
+    try:
+        run_job(json.loads(job_file.read_text(encoding='utf8')), resources)
+    finally:
+        resources.close()
@@ -0,0 +1,151 @@
+'''
+Append only journal of the work done in a run, so an interrupted run can resume.
+'''
+
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class RunJournal:
+    '''
+    Records state changes of the products and images of a run in a SQLite file.
+
+    Every stage ('scrape', 'download') has its own runs. begin() starts a run,
+    or resumes the last one if it never reached end(), returning the last
+    state of every key recorded in it. Events of older runs are dropped when a
+    new run starts.
+
+    Events are committed in batches of batch_size, or after flush_interval
+    seconds, so journaling doesn't cost a disk sync per image. A crash loses at
+    most the last batch, which only means that work is done again.
+    '''
+
+    def __init__(self, path: pathlib.Path, batch_size: int = 64, flush_interval: float = 1.0):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.runs: dict[str, str] = {}
+        self.buffer: list[tuple] = []
+        self.flushed = time.monotonic()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(
+                '''CREATE TABLE IF NOT EXISTS events (
+                       seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                       run TEXT,
+                       stage TEXT,
+                       key TEXT,
+                       state TEXT,
+                       detail TEXT,
+                       at REAL
+                   )'''
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS events_run ON events (stage, run, key)'
+            )
+
+    def begin(self, stage: str) -> dict[str, tuple[str, dict]]:
+        '''
+        Starts a run of stage. If the last run of stage was interrupted it is
+        resumed, and the last state and detail of every key it recorded are
+        returned. Otherwise returns an empty dict.
+        '''
+        with self.lock, self.connection:
+            last = self.connection.execute(
+                "SELECT run, state FROM events WHERE stage = ? AND key = '' "
+                'ORDER BY seq DESC LIMIT 1', (stage,)
+            ).fetchone()
+            if last is not None and last[1] == 'started':
+                run = last[0]
+                rows = self.connection.execute(
+                    '''SELECT key, state, detail FROM events WHERE seq IN (
+                           SELECT MAX(seq) FROM events
+                           WHERE stage = ? AND run = ? AND key != '' GROUP BY key
+                       )''', (stage, run)
+                ).fetchall()
+                self.runs[stage] = run
+                return {key: (state, json.loads(detail)) for key, state, detail in rows}
+
+            run = uuid.uuid4().hex
+            self.runs[stage] = run
+            self.connection.execute('DELETE FROM events WHERE stage = ?', (stage,))
+            self.connection.execute(
+                "INSERT INTO events (run, stage, key, state, detail, at) VALUES (?, ?, '', ?, '{}', ?)",
+                (run, stage, 'started', time.time())
+            )
+            return {}
+
+    def record(self, stage: str, key: str, state: str, **detail) -> None:
+        '''
+        Appends a state change of key to the current run of stage.
+        '''
+        with self.lock:
+            run = self.runs.get(stage)
+            if run is None:
+                return
+            self.buffer.append((run, stage, key, state, json.dumps(detail), time.time()))
+            if len(self.buffer) >= self.batch_size or \
+               time.monotonic() - self.flushed >= self.flush_interval:
+                self._flush()
+
+    def flush(self) -> None:
+        '''
+        Commits the buffered events.
+        '''
+        with self.lock:
+            self._flush()
+
+    def end(self, stage: str) -> None:
+        '''
+        Marks the current run of stage as finished, so the next begin() starts over.
+        '''
+        self.record(stage, '', 'finished')
+        with self.lock:
+            self._flush()
+            self.runs.pop(stage, None)
+
+    def progress(self, stage: str) -> tuple[bool, dict[str, int]] | None:
+        '''
+        Whether the last run of stage finished, and how many keys it left in
+        each state, as committed so far. None if stage never ran. Can be called
+        from another process while the run goes on.
+        '''
+        with self.lock:
+            last = self.connection.execute(
+                "SELECT run, state FROM events WHERE stage = ? AND key = '' "
+                'ORDER BY seq DESC LIMIT 1', (stage,)
+            ).fetchone()
+            if last is None:
+                return None
+            rows = self.connection.execute(
+                '''SELECT state, COUNT(*) FROM events WHERE seq IN (
+                       SELECT MAX(seq) FROM events
+                       WHERE stage = ? AND run = ? AND key != '' GROUP BY key
+                   ) GROUP BY state''', (stage, last[0])
+            ).fetchall()
+        return last[1] == 'finished', dict(rows)
+
+    def close(self) -> None:
+        '''
+        Commits the buffered events and closes the database connection.
+        '''
+        with self.lock:
+            self._flush()
+            self.connection.close()
+
+    def _flush(self) -> None:
+        if self.buffer:
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT INTO events (run, stage, key, state, detail, at) VALUES (?, ?, ?, ?, ?, ?)',
+                    self.buffer
+                )
+            self.buffer = []
+        self.flushed = time.monotonic()
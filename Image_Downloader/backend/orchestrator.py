@@ -0,0 +1,124 @@
+'''
+Runs the pipelines of several suppliers at once, in one process.
+'''
+
+import importlib
+import json
+import pathlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from .resources import SharedResources
+from .session import configure
+from .throttle import Throttle
+
+suppliers_path = pathlib.Path(__file__).parent.parent / 'suppliers'
+JOB_OPTIONS = {'supplier', 'file', 'engine', 'stream', 'incremental'}
+
+
+def check_job(job: dict, suppliers_dir: pathlib.Path = suppliers_path) -> dict:
+    '''
+    Raises ValueError if job isn't a valid job of a supplier in suppliers_dir. Returns the job.
+    '''
+    if not isinstance(job, dict) or 'supplier' not in job:
+        raise ValueError(f'A job needs at least a supplier: {job}')
+    unknown = set(job) - JOB_OPTIONS
+    if unknown:
+        raise ValueError(f'Unknown job options {sorted(unknown)}: {job}')
+    if not (suppliers_dir / str(job['supplier']) / '__main__.py').exists():
+        raise ValueError(f"No supplier named {job['supplier']}")
+    if job.get('engine', 'threads') not in ('threads', 'async'):
+        raise ValueError(f"engine is either 'threads' or 'async': {job}")
+    return job
+
+
+def load_jobs(path: str | pathlib.Path) -> list[dict]:
+    '''
+    Reads a job list, a JSON list of jobs such as
+    {"supplier": "kentia", "file": "kentia.xlsx", "engine": "async", "stream": true, "incremental": false}
+    Only the supplier is required. Without a file the supplier reads its data directory.
+    '''
+    jobs = json.loads(pathlib.Path(path).read_text(encoding='utf8'))
+    if not isinstance(jobs, list):
+        raise ValueError('The job list must be a JSON list')
+    return [check_job(job) for job in jobs]
+
+
+class Orchestrator:
+    '''
+    Runs the pipelines of several suppliers at the same time, on threads of a
+    single process, instead of one process per supplier. While one supplier is
+    scraping another one's images are being transformed, so the network and the
+    cores are busy throughout.
+
+    The jobs share the process wide HTTP client, so its connection pools and
+    per host limits, one pool of transform_processes processes and one budget
+    of max_in_flight_bytes for the images waiting for their transformation.
+    max_requests caps the requests in flight to all the suppliers together.
+
+    At most max_parallel suppliers run at once, all of them by default. Jobs of
+    the same supplier share its directory, so they run one after the other.
+
+    Usage:
+    Orchestrator(load_jobs('jobs.json')).run()
+    '''
+
+    def __init__(self, jobs: list[dict],
+                 max_parallel: int | None = None,
+                 transform_processes: int | None = None,
+                 max_in_flight_bytes: int = 512 * 1024 ** 2,
+                 max_requests: int = 128):
+        self.jobs = [check_job(job) for job in jobs]
+        self.max_parallel = max_parallel
+        self.transform_processes = transform_processes
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.max_requests = max_requests
+        self.errors: dict[int, str] = {}
+
+    def run(self) -> bool:
+        '''
+        Runs every job and returns whether they all succeeded.
+        The errors are kept in errors, by the index of the job.
+        '''
+        by_supplier: dict[str, list[int]] = {}
+        for index, job in enumerate(self.jobs):
+            by_supplier.setdefault(job['supplier'], []).append(index)
+        if not by_supplier:
+            return True
+
+        configure(pool_connections=max(10, len(by_supplier)),
+                  throttle=Throttle(max_in_flight=self.max_requests))
+        resources = SharedResources(self.transform_processes, self.max_in_flight_bytes)
+        self.errors = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_parallel or len(by_supplier)) as executor:
+                for indexes in by_supplier.values():
+                    executor.submit(self._run_jobs, indexes, resources)
+        finally:
+            resources.close()
+
+        for index, job in enumerate(self.jobs):
+            outcome = 'failed' if index in self.errors else 'done'
+            print(f"Job {index} {job['supplier']} {job.get('file', '')}: {outcome}")
+        return not self.errors
+
+    def _run_jobs(self, indexes: list[int], resources: SharedResources) -> None:
+        for index in indexes:
+            job = self.jobs[index]
+            try:
+                run_job(job, resources)
+            except (Exception, SystemExit) as e: # pylint: disable=broad-exception-caught
+                traceback.print_exc()
+                self.errors[index] = f'{type(e).__name__}: {e}'
+
+
+def run_job(job: dict, resources: SharedResources | None = None) -> None:
+    '''
+    Runs the supplier script of job, with resources if given.
+    '''
+    module = importlib.import_module(f".suppliers.{job['supplier']}.__main__", 'Image_Downloader')
+    module.main(engine=job.get('engine', 'threads'),
+                stream=job.get('stream', True),
+                incremental=job.get('incremental', False),
+                filename=job.get('file'),
+                resources=resources)
@@ -3,16 +3,24 @@ This module handles scrapping of image links from product pages. It exposes an i
 unique supplier scripts to handle html parsing.
 '''
 
-import os
 import pathlib
-import sys
-import pickle
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, Future
 from urllib.parse import urlparse
 from abc import abstractmethod
 
+import numpy as np
 import pandas as pd
 import requests
 
+from .session import get_client
+from .cache import PageCache, CacheEntry
+from .search import SearchMemo, SearchResolver
+from .journal import RunJournal
+
+VALID_URL = r'(?i)https?://[^/?#\s]'
+
 class ProductPageGetter:
     '''
     Purpose:
@@ -32,10 +40,17 @@ class ProductPageGetter:
 
     Usage: 
     Create a class that inherits from ProductPageGetter and call the run() function. 
-    The object will download all product pages and save them to .cache directory.
-    The cache is eternal, so if you think that the data in pages have changed, 
-    delete the contents of the .cache dir.
+    The object will download all product pages and save them to the pagecache.sqlite file.
+    On later runs pages are revalidated with a conditional request (ETag/Last-Modified),
+    so unchanged pages aren't downloaded again. Pages without validators are trusted for a
+    week before being downloaded again, unused pages
+    expire after 90 days and the file is kept under 2GB. Pass your own backend.cache.PageCache
+    as cache to change those limits. The .cache directory of older versions is no longer used
+    and can be deleted.
     Products with invalid URLs are logged in logs.txt
+    Every parsed product is recorded in journal.sqlite. If a run is interrupted,
+    the next run resumes it: finished products are replayed from the journal
+    instead of being requested again.
 
     
     You can define the following functions:
@@ -56,33 +71,59 @@ class ProductPageGetter:
     because the function is called for every product.
 
     To handle unfound/invalid links, return None
+    and let errors like requests.HTTPError propagate, so the product isn't
+    remembered as not found and is searched again on the next run.
+    Searches run concurrently before the pages are fetched and their answers are
+    remembered in search.sqlite, found URLs for 30 days and products that weren't
+    found for a day. Set search_rate to limit the calls per second.
+
+    If the supplier's search API can look up many products in one call, set
+    search_batch_size and define
+
+    def search_batch(self, skus: list[str]) -> dict[str, str | None]
+
+    returning the URL of every sku it found.
+
+    Use self.http.get instead of requests.get so the search calls reuse the
+    pooled keep-alive connections and share the per host throttle with the page
+    and image requests. Pool size, timeouts and the throttle can be changed with
+    backend.session.configure before the getter is created.
 
 
     def fix_title(self, title: str) -> str
 
-    The program uses the title as a name for the cached results. If your title contains characters
-    that can be used as filenames by the OS, you can use this to replace the invalid characters
+    Cleans up the title before it's used in messages. If your title contains characters
+    that can't be used as filenames by the OS, you can use this to replace the invalid characters
     
     By default it only changes the '/' character to '---'.
     '''
 
+    search_batch_size: int = 1
+    search_rate: float | None = None
+
     def __init__(self, worksheet: pd.DataFrame,
                  supplier_path: pathlib.Path,
                  *tablenames: str,
-                 failed_only: bool = False):
+                 failed_only: bool = False,
+                 parallel_connections: int = 16,
+                 cache: PageCache | None = None):
 
 
         title_column, sku_column, url_column = tablenames
 
         self.app_path = supplier_path
-        self.cache_path: pathlib.Path = self.app_path / '.cache'
-        if not self.cache_path.exists():
-            self.cache_path.mkdir()
-        self.cached_files: list[str] = [
-            str(x).rsplit(os.sep, maxsplit=1)[-1] for
-            x in  self.cache_path.iterdir()
-        ]
-        self.no_of_parallel_connections: int = 4
+        self.cache = PageCache(self.app_path / 'pagecache.sqlite') if cache is None else cache
+        self.journal = RunJournal(self.app_path / 'journal.sqlite')
+        self._journaled: dict[str, tuple[list[str], list[str]]] = {}
+        self.no_of_parallel_connections: int = max(1, parallel_connections)
+        self.http = get_client()
+        self.resolver = SearchResolver(
+            self.search, SearchMemo(self.app_path / 'search.sqlite'),
+            max_workers=self.no_of_parallel_connections,
+            rate=self.search_rate,
+            batch_search=self.search_batch if self.search_batch_size > 1 else None,
+            batch_size=self.search_batch_size
+        )
         self.not_found = []
         self.headers = {
             "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 \
@@ -103,54 +144,141 @@ class ProductPageGetter:
                     skus_in_log.append(sku.strip())
 
             if skus_in_log:
-                self.url_table.index = pd.Index(self.url_table[sku_column])
-                self.url_table = self.url_table.loc[skus_in_log]
+                skus = self.url_table[sku_column].astype(str).str.strip()
+                self.url_table = self.url_table[skus.isin(skus_in_log)]
 
 
-    def run(self):
+    def run(self, on_link: Callable[[str, str], None] | None = None):
         '''
         The high level API to be used in supplied scripts.
-        '''
-        self.url_table.fillna('', inplace=True)
-        print(f'Found {len(self.url_table)} products.\nDownloading...')
 
+        Up to no_of_parallel_connections products are fetched and parsed
+        at the same time. Results are written to links.txt and logs.txt
+        in the order of the worksheet.
+
+        on_link is called with the filename and url of every image as soon
+        as its page is parsed, for example ImageDownloader.put to start
+        downloading while the rest of the pages are scraped.
+        '''
+        plan = self.resolve_searches(self.plan())
+        try:
+            self._scrape(plan, on_link)
+        except BaseException:
+            self.journal.flush()
+            raise
+        self.journal.end('scrape')
+        self.cache.evict()
+
+    def _scrape(self, plan: pd.DataFrame, on_link: Callable[[str, str], None] | None) -> None:
+        window = self.no_of_parallel_connections * 2
         with (
             (self.app_path / 'logs.txt').open('w') as log_file,
-            (self.app_path / 'links.txt').open('a' if self.failed_only else 'w') as links_file
+            (self.app_path / 'links.txt').open('a' if self.failed_only else 'w') as links_file,
+            ThreadPoolExecutor(max_workers=self.no_of_parallel_connections) as executor
         ):
-
-            for i, row in self.url_table.iterrows():
-                title, sku, url = row
-                resp = self._request_page(title, sku, url)
-                if not resp:
-                    log_file.write(f'Failed - No Product Page Found - \
-                                    {sku} - {title} - URL:{url}\n')
+            pending: deque[Future[tuple[list[str], list[str]]]] = deque()
+            for title, sku, url, action in plan.itertuples(index=False, name=None):
+                pending.append(executor.submit(self._process_product, title, sku, url, action))
+                if len(pending) >= window:
+                    self._write_result(pending.popleft().result(), log_file, links_file, on_link)
+            while pending:
+                self._write_result(pending.popleft().result(), log_file, links_file, on_link)
+
+    def plan(self) -> pd.DataFrame:
+        '''
+        Works out what every product needs before any network work starts.
+        Titles are fixed, URLs validated and the cache checked column wise.
+        Returns a table with the title, sku, url and action columns, where
+        action is 'cached' for pages that can be used straight from the cache,
+        'fetch' for pages to request, 'search' for products without a
+        valid URL and 'journaled' for products an interrupted run finished.
+        '''
+        table = self.url_table.fillna('').astype(str)
+        table.columns = pd.Index(['title', 'sku', 'url'])
+        if type(self).fix_title is ProductPageGetter.fix_title:
+            table['title'] = table['title'].str.replace('/', '---', regex=False)
+        else:
+            table['title'] = table['title'].map(self.fix_title)
+
+        valid = table['url'].str.strip().str.match(VALID_URL)
+        cached, fresh = self.cache.fresh_many(table['sku'])
+        table['action'] = np.select([fresh, cached | valid], ['cached', 'fetch'], 'search')
+
+        self._journaled = {sku: (detail['logs'], detail['entries'])
+                           for sku, (state, detail) in self.journal.begin('scrape').items()
+                           if state == 'done'}
+        table.loc[table['sku'].isin(self._journaled), 'action'] = 'journaled'
+
+        counts = table['action'].value_counts()
+        print(f'Found {len(table)} products. {counts.get("cached", 0)} cached, '
+              f'{counts.get("fetch", 0)} to fetch, {counts.get("search", 0)} to search, '
+              f'{counts.get("journaled", 0)} finished by the interrupted run.\n'
+              'Downloading...')
+        return table
+
+    def resolve_searches(self, plan: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Looks up all the products of the plan that need a search at once.
+        Found products become 'fetch' with their URL, the rest 'not_found'.
+        '''
+        needs_search = plan['action'] == 'search'
+        if not needs_search.any():
+            return plan
+
+        skus = plan.loc[needs_search, 'sku']
+        found = self.resolver.resolve_many(skus)
+        urls = skus.map(found).fillna('').astype(str)
+        valid = urls.str.match(VALID_URL)
+        plan.loc[needs_search, 'url'] = urls.where(valid, plan.loc[needs_search, 'url'])
+        plan.loc[needs_search, 'action'] = np.where(valid, 'fetch', 'not_found')
+        print(f'Search found {int(valid.sum())} of {len(skus)} products.')
+        return plan
+
+    def _process_product(self, title: str, sku: str, url: str,
+                         action: str) -> tuple[list[str], list[str]]:
+        '''
+        Fetches and parses a single product page of the plan.
+        Returns the lines meant for logs.txt and links.txt.
+        '''
+        if action == 'journaled':
+            return self._journaled[sku]
+        return self._parse_product(title, sku, url, self._fetch_page(title, sku, url, action))
+
+    def _parse_product(self, title: str, sku: str, url: str,
+                       resp: requests.Response | None) -> tuple[list[str], list[str]]:
+        logs: list[str] = []
+        entries: list[str] = []
+        if not resp:
+            logs.append(f'Failed - No Product Page Found - \
+                            {sku} - {title} - URL:{url}\n')
+        else:
+            image_links: list[str] = self.parse_html(resp.text)
+            if len(image_links) == 0:
+                logs.append(f'Failed - No Images Found - \
+                            {sku} - {title} - URL:{resp.url}\n')
+            for i, link in enumerate(image_links):
+                if '.' in link:
+                    *_, ext = link.split('.')
                 else:
-                    image_links: list[str] = self.parse_html(resp.text)
-                    if len(image_links) == 0:
-                        log_file.write(f'Failed - No Images Found - \
-                                        {sku} - {title} - URL:{resp.url}\n')
-                    for i, link in enumerate(image_links):
-                        if '.' in link:
-                            *_, ext = link.split('.')
-                        else:
-                            ext = 'jpg'
-                        entry = f'{sku}_{i}.{ext}|{link}'
-                        print(entry)
-                        links_file.write(entry+'\n')
-
-
-    def _is_cached(self, title: str) -> bool:
-        return title in self.cached_files
-
-    def _add_to_cache(self, title: str, obj: requests.Response):
-        with (self.cache_path / title).open('wb') as f:
-            pickle.dump(obj, f)
-
-    def _retrieve_from_cache(self, title, sku):
-        print(f'Retrieving {sku} - {title} page from Cache')
-        with (self.cache_path / title).open('rb') as f:
-            return pickle.load(f)
+                    ext = 'jpg'
+                entries.append(f'{sku}_{i}.{ext}|{link}')
+        # Failed pages, timeouts included, are fetched again by a resumed run
+        self.journal.record('scrape', sku, 'done' if resp else 'failed', logs=logs, entries=entries)
+        return logs, entries
+
+    def _write_result(self, result: tuple[list[str], list[str]], log_file, links_file,
+                      on_link: Callable[[str, str], None] | None = None) -> None:
+        logs, entries = result
+        log_file.writelines(logs)
+        for entry in entries:
+            print(entry)
+            links_file.write(entry+'\n')
+        if on_link is not None:
+            links_file.flush()
+            for entry in entries:
+                filename, link = entry.split('|', maxsplit=1)
+                on_link(filename, link)
+
 
     def _is_valid_url(self, url: str):
         parse_result = urlparse(url)
@@ -170,33 +298,73 @@ class ProductPageGetter:
             title = title.replace('/', '---')
         return title
 
-    def _request_page(self, title: str, sku: str, product_url: str) -> requests.Response | None:
-        title = self.fix_title(title)
-
-
-        is_cached = self._is_cached(title)
-        resp: requests.Response
-        interrupt = False
+    def _plan_request(self, title: str, sku: str,
+                      product_url: str) -> tuple[requests.Response | None, str | None, CacheEntry | None]:
+        '''
+        Looks the product up in the cache and falls back to search() for invalid URLs.
+        Returns the fresh cached page, or the url to request together with the
+        stale cache entry to revalidate, if any.
+        '''
+        entry = self.cache.get(str(sku))
+        if entry is not None and not self.cache.is_stale(entry):
+            print(f'Retrieving {sku} - {title} page from Cache')
+            return entry.response, None, None
+
+        if not self._is_valid_url(product_url):
+            if entry is not None:
+                return None, entry.response.url, entry
+            url: str | None = self.resolver.resolve(str(sku))
+            if url is None or not self._is_valid_url(url):
+                self.not_found.append(f'Not Found: {sku} - {title}')
+                return None, None, None
+            product_url = url
+        return None, product_url, entry
 
+    def _store_response(self, title: str, sku: str, resp: requests.Response,
+                        entry: CacheEntry | None) -> requests.Response:
+        '''
+        Updates the cache with a fresh response and returns the page to parse.
+        '''
+        if resp.status_code == 304 and entry is not None:
+            self.cache.touch(str(sku), resp)
+            print(f'Page {sku} - {title} not modified, using cache')
+            return entry.response
+        if resp.status_code == 200:
+            self.cache.put(str(sku), resp)
+            print(f'Added {sku} - {title} to cache')
+        return resp
 
-        if not is_cached and not self._is_valid_url(product_url):
-            url: str | None = self.search(sku)
-            if url is None:
-                self.not_found.append(f'Not Found: {sku} - {title}')
-                return None
-            if url:
-                if self._is_valid_url(url):
-                    product_url = url
+    def _cached_page(self, title: str, sku: str) -> requests.Response | None:
+        entry = self.cache.get(str(sku))
+        if entry is None:
+            return None
+        print(f'Retrieving {sku} - {title} page from Cache')
+        return entry.response
 
+    def _request_page(self, title: str, sku: str, product_url: str) -> requests.Response | None:
+        return self._fetch_page(self.fix_title(title), sku, product_url)
+
+    def _fetch_page(self, title: str, sku: str, product_url: str,
+                    action: str | None = None) -> requests.Response | None:
+        if action == 'cached' and (page := self._cached_page(title, sku)) is not None:
+            return page
+        if action == 'not_found':
+            self.not_found.append(f'Not Found: {sku} - {title}')
+            return None
+
+        cached, url, entry = self._plan_request(title, sku, product_url)
+        if cached is not None:
+            return cached
+        if url is None:
+            return None
+
+        resp: requests.Response | None = None
         try:
-            if is_cached:
-                resp = self._retrieve_from_cache(title, sku)
-            else:
-                print(f'Requesting page {product_url}')
-                resp = requests.get(product_url, headers=self.headers, timeout=10)
-                resp.raise_for_status()
-                message = f'Request for page {sku} - {title} successful'
-                print(message)
+            print(f'Requesting page {url}')
+            resp = self.http.get(url, headers={**self.headers, **self.cache.validators(entry)})
+            resp.raise_for_status()
+            message = f'Request for page {sku} - {title} successful'
+            print(message)
 
         except requests.HTTPError as e:
             message = f'{e} Failed to get page for {title} - {sku}. \
@@ -208,14 +376,13 @@ class ProductPageGetter:
                         Connection timed out'
             print(message)
 
-        finally:
-            if resp and resp.status_code == 200 and not is_cached:
-                self._add_to_cache(title, resp)
-                print(f'Added {sku} - {title} to cache')
-            if interrupt:
-                sys.exit(2)
+        except requests.RequestException as e:
+            message = f'{e} Failed to get page for {title} - {sku}.'
+            print(message)
 
-        return resp
+        if resp is None:
+            return None
+        return self._store_response(title, sku, resp, entry)
 
     @abstractmethod
     def parse_html(self, html_page, *args) -> list[str]:
@@ -223,6 +390,13 @@ class ProductPageGetter:
         Abstract method to be used in supplier's __main__
         '''
 
+    def search_batch(self, skus: list[str]) -> dict[str, str | None]:
+        '''
+        Interface method to be used in supplier's __main__ together with
+        search_batch_size, if the search API accepts many products per call.
+        '''
+        raise NotImplementedError()
+
     @abstractmethod
     def search(self, sku, *args) -> str | None:
         '''
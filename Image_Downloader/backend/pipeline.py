@@ -0,0 +1,43 @@
+'''
+Runs the scraping and downloading stages of a supplier script.
+'''
+
+from .pagegetter import ProductPageGetter
+from .downloader import ImageDownloader
+
+
+def run_pipeline(page_getter: ProductPageGetter | None,
+                 downloader: ImageDownloader,
+                 engine: str = 'threads',
+                 stream: bool = True) -> None:
+    '''
+    Scrapes the product pages with page_getter, if given, and downloads the
+    images listed in links.txt with downloader.
+
+    engine is either 'threads' or 'async'.
+    With stream set, every image link goes to the downloader as soon as its
+    page is parsed, so downloads overlap with the scraping of the remaining
+    pages. links.txt is written either way.
+    '''
+    if engine == 'async':
+        # Imported here so the threaded engine doesn't need aiohttp installed
+        from .asyncengine import AsyncEngine # pylint: disable=import-outside-toplevel
+        AsyncEngine(downloader, page_getter, stream=stream).run()
+        return
+
+    if page_getter is None:
+        downloader.run()
+        return
+
+    if not stream:
+        page_getter.run()
+        downloader.run()
+        return
+
+    downloader.start()
+    try:
+        page_getter.run(on_link=downloader.put)
+    except BaseException:
+        downloader.finish(completed=False)
+        raise
+    downloader.finish()
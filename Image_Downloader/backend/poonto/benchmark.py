@@ -0,0 +1,104 @@
+'''
+Measures the images per second of resize_image against the previous
+implementation on large supplier-like JPEGs.
+
+Usage:
+python -m Image_Downloader.backend.poonto.benchmark [image.jpg ...]
+
+Without arguments it generates 2000 to 4000 pixel JPEGs to test on.
+'''
+
+import io
+import random
+import sys
+import time
+from collections.abc import Callable
+
+from PIL import Image, ImageDraw
+
+from .imagecropper import resize_image
+
+
+def legacy_resize_image(imagebytes: bytes, dimensions: tuple[int, int], extension: str) -> bytes:
+    '''
+    resize_image as it was before the fast path, kept as the baseline.
+    '''
+    background = Image.new(mode='RGB', size=(740, 740), color=(255,255,255))
+    new_image = Image.open(io.BytesIO(imagebytes))
+    new_image.thumbnail(dimensions)
+    correction_width = (dimensions[0] - new_image.width) // 2
+    correction_height = (dimensions[1] - new_image.height) // 2
+    background.paste(new_image, box=(correction_width, correction_height))
+
+    if extension == 'jpg':
+        extension = 'jpeg'
+
+    with io.BytesIO() as buffer:
+        background.save(buffer, format=extension)
+        buffer.seek(0)
+        return buffer.read()
+
+
+def sample_images(count: int = 12, seed: int = 0) -> list[bytes]:
+    '''
+    JPEGs between 2000 and 4000 pixels a side, half of them square,
+    with enough detail to compress like product photos.
+    '''
+    rng = random.Random(seed)
+    images = []
+    for i in range(count):
+        width = rng.randrange(2000, 4001)
+        height = width if i % 2 == 0 else rng.randrange(2000, 4001)
+        image = Image.new('RGB', (width, height), (255, 255, 255))
+        draw = ImageDraw.Draw(image)
+        for _ in range(200):
+            x, y = rng.randrange(width), rng.randrange(height)
+            draw.ellipse((x, y, x + rng.randrange(50, 600), y + rng.randrange(50, 600)),
+                         fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        with io.BytesIO() as buffer:
+            image.save(buffer, format='jpeg', quality=90)
+            images.append(buffer.getvalue())
+    return images
+
+
+def measure(function: Callable[[bytes], bytes], images: list[bytes], rounds: int = 3) -> float:
+    '''
+    The best images per second of function over rounds passes.
+    '''
+    best = 0.0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for image in images:
+            function(image)
+        best = max(best, len(images) / (time.perf_counter() - start))
+    return best
+
+
+def main() -> None:
+    '''
+    Prints the images per second of every variant.
+    '''
+    if len(sys.argv) > 1:
+        images = [open(name, 'rb').read() for name in sys.argv[1:]] # pylint: disable=consider-using-with
+    else:
+        print('Generating sample images...')
+        images = sample_images()
+
+    dimensions = (740, 740)
+    variants: dict[str, Callable[[bytes], bytes]] = {
+        'previous resize_image': lambda image: legacy_resize_image(image, dimensions, 'jpg'),
+        'resize_image': lambda image: resize_image(image, dimensions, 'jpg'),
+        'resize_image, reducing_gap=1.1': lambda image: resize_image(
+            image, dimensions, 'jpg', reducing_gap=1.1),
+        'resize_image, quality=85, optimize': lambda image: resize_image(
+            image, dimensions, 'jpg', quality=85, optimize=True),
+    }
+    baseline = None
+    for name, function in variants.items():
+        rate = measure(function, images)
+        baseline = baseline or rate
+        print(f'{name:45} {rate:7.1f} images/s  {rate / baseline:4.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,44 @@
-from PIL import Image
-import io
-
-# Atrocious legacy code I wrote 2 weeks into learning Python early in my career.
-# Modified it to interface with my program.
-# It crops away a [NEW] stamp from this supplier's product images.
-
-def has_NEW(img) -> bool:
-    row = 40
-    column = 40
-    try:  #checks for a specific magenta'ish color to determine if the "NEW" stamp exists.
-        for i in range(10):
-            for y in range(10):
-                pixel = img.getpixel((row+y,column+i))
-                if (225 <= pixel[0] and pixel[0] <= 232) and (2 <= pixel[1] and pixel[1] <= 10) and (120 <= pixel[2] and pixel[2] <= 130): 
-                    return True
-                else: break
-    except: return False
-    return False
-
-
-def crop(img: Image.Image) -> None:
-    cropbox = (0, 147, img.width, img.height) #left, upper, right, lower
-    img = img.crop(cropbox)
- 
-
-
-
-def remove_new(image: Image.Image) -> None:
-    if has_NEW(image):
-        crop(image)
-        
+'''
+Crops away the [NEW] stamp from kentia's product images.
+'''
 
+import numpy as np
+from PIL import Image
 
+# Where the stamp is sampled and the height of the band it sits in,
+# in pixels of the original image.
+STAMP_BOX = (40, 40, 50, 50) #left, upper, right, lower
+STAMP_COLOR = (228, 6, 125)
+STAMP_HEIGHT = 147
+
+
+def has_new(image: Image.Image, scale: float = 1.0,
+            tolerance: int = 5, min_fraction: float = 0.5) -> bool:
+    '''
+    Checks for the magenta'ish color of the "NEW" stamp in the sample window.
+    A pixel matches if every channel is within tolerance of STAMP_COLOR, and the
+    stamp is found if at least min_fraction of the window matches.
+    scale is the size of image relative to the original, for drafted JPEGs.
+    '''
+    box = tuple(round(edge * scale) for edge in STAMP_BOX)
+    if box[2] > image.width or box[3] > image.height or box[0] == box[2] or box[1] == box[3]:
+        return False
+    window = np.asarray(image.crop(box).convert('RGB'), dtype=np.int16)
+    matches = (np.abs(window - np.array(STAMP_COLOR, dtype=np.int16)) <= tolerance).all(axis=-1)
+    return bool(matches.mean() >= min_fraction)
+
+
+def crop(image: Image.Image, scale: float = 1.0) -> Image.Image:
+    '''
+    Cuts the band with the stamp off the top of the image.
+    '''
+    return image.crop((0, round(STAMP_HEIGHT * scale), image.width, image.height))
+
+
+def remove_new(image: Image.Image, scale: float = 1.0, tolerance: int = 5) -> Image.Image:
+    '''
+    Returns the image without the stamp band if it has the stamp, otherwise the image itself.
+    '''
+    if has_new(image, scale, tolerance):
+        return crop(image, scale)
+    return image
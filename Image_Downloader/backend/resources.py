@@ -0,0 +1,73 @@
+'''
+Pools and budgets shared by the downloaders of suppliers that run at the same time.
+'''
+
+import multiprocessing
+import os
+import pathlib
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .imagestore import ImageStore
+from .spool import ByteBudget
+
+
+class SharedResources:
+    '''
+    One pool of transform_processes processes (defaults to the number of cores)
+    and one budget of max_in_flight_bytes for the images waiting for their
+    transformation, for every ImageDownloader created with it. Downloaders
+    running at once then use the machine like a single one, instead of each
+    starting a process per core and holding its own budget.
+
+    The HTTP connection pools and the request limits are shared already,
+    through session.get_client().
+
+    The image stores of the downloaders are evicted once, by close(), instead of
+    by every downloader as it ends. Objects used since the resources were
+    created are kept. store_root puts the store of every downloader there
+    instead of next to its supplier directory.
+
+    Call close() once every downloader is done.
+    '''
+
+    def __init__(self, transform_processes: int | None = None,
+                 max_in_flight_bytes: int = 512 * 1024 ** 2,
+                 store_root: pathlib.Path | None = None):
+        if transform_processes is None:
+            transform_processes = os.cpu_count() or 1
+        self.transform_processes = max(0, transform_processes)
+        self.budget = ByteBudget(max_in_flight_bytes)
+        self.started = time.time()
+        self.store_root = store_root
+        self.stores: dict[pathlib.Path, ImageStore] = {}
+        self.lock = threading.Lock()
+        self.transform_pool: ProcessPoolExecutor | None = None
+        self.transform_slots: threading.BoundedSemaphore | None = None
+        if self.transform_processes:
+            self.transform_pool = ProcessPoolExecutor(
+                max_workers=self.transform_processes,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            self.transform_slots = threading.BoundedSemaphore(self.transform_processes * 2)
+
+    def add_store(self, store: ImageStore) -> None:
+        '''
+        Registers the image store of a downloader, to be evicted by close().
+        '''
+        with self.lock:
+            self.stores.setdefault(store.root, store)
+
+    def close(self) -> None:
+        '''
+        Waits for the transformations, stops the processes and evicts the image stores.
+        '''
+        if self.transform_pool is not None:
+            self.transform_pool.shutdown(wait=True)
+            self.transform_pool = None
+        with self.lock:
+            stores = list(self.stores.values())
+            self.stores = {}
+        for store in stores:
+            store.evict(keep_since=self.started)
@@ -0,0 +1,71 @@
+'''
+Structured record of how every image of a run was downloaded.
+'''
+
+import pathlib
+import sqlite3
+import threading
+import time
+
+
+class ResultStore:
+    '''
+    Keeps the outcome of the last run for every image in a SQLite file,
+    keyed by filename. Replaces the Failed_log files in the images directory.
+    '''
+
+    columns = ('filename', 'url', 'success', 'status_code', 'timeout', 'reason', 'attempts', 'updated')
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                '''CREATE TABLE IF NOT EXISTS results (
+                       filename TEXT PRIMARY KEY,
+                       url TEXT,
+                       success INTEGER,
+                       status_code INTEGER,
+                       timeout INTEGER,
+                       reason TEXT,
+                       attempts INTEGER,
+                       updated REAL
+                   )'''
+            )
+
+    def record(self, log: dict) -> None:
+        '''
+        Stores the outcome of a download log, replacing any earlier one.
+        '''
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (log['filename'], log['url'], bool(log['success']), log['status_code'],
+                 bool(log['timeout']), str(log['reason']), log.get('attempts', 1), time.time())
+            )
+
+    def failures(self) -> list[dict]:
+        '''
+        The logs of every image that failed.
+        '''
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT * FROM results WHERE NOT success ORDER BY filename'
+            ).fetchall()
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    def clear(self) -> None:
+        '''
+        Forgets every result, at the start of a new run.
+        '''
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM results')
+
+    def close(self) -> None:
+        '''
+        Closes the database connection.
+        '''
+        with self.lock:
+            self.connection.close()
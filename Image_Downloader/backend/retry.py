@@ -0,0 +1,155 @@
+'''
+Retries failed downloads later in the run instead of giving up on the first error.
+'''
+
+import heapq
+import itertools
+import random
+import threading
+import time
+from collections.abc import Callable
+from typing import NamedTuple
+
+
+class Backoff(NamedTuple):
+    '''
+    How a class of errors is retried. The n-th retry waits a random time up to
+    base_delay * 2 ** (n - 1) seconds, capped at max_delay.
+    '''
+    max_attempts: int
+    base_delay: float
+    max_delay: float
+
+
+DEFAULT_BACKOFF = {
+    'timeout': Backoff(4, 1.0, 30.0),
+    'connection': Backoff(4, 2.0, 60.0),
+    'throttled': Backoff(6, 5.0, 120.0),
+    'server': Backoff(3, 2.0, 30.0),
+}
+
+
+def error_class(status_code: int | None, timeout: bool = False) -> str | None:
+    '''
+    The kind of a failed request, or None if retrying it wouldn't help.
+    A request without a status code or timeout failed to connect.
+    '''
+    if timeout:
+        return 'timeout'
+    if status_code is None:
+        return 'connection'
+    if status_code in (429, 503):
+        return 'throttled'
+    if status_code >= 500 or status_code == 408:
+        return 'server'
+    return None
+
+
+class RetryPolicy:
+    '''
+    Decides whether and when a failed request is retried.
+
+    backoff maps each error class from error_class() to its Backoff. The
+    delays use full jitter, so retries of images that failed together don't
+    hit the supplier together again. A Retry-After header is respected up to
+    the max_delay of the error class. A request asked to wait longer isn't
+    retried, so one response can't stall the run.
+
+    Retries come out of a budget of min_retries plus budget_ratio times the
+    number of requests made, so a supplier that is down doesn't get every
+    image retried several times over.
+    '''
+
+    def __init__(self, backoff: dict[str, Backoff] | None = None,
+                 budget_ratio: float = 0.2,
+                 min_retries: int = 10):
+
+        self.backoff = DEFAULT_BACKOFF if backoff is None else backoff
+        self.budget_ratio = budget_ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def request(self) -> None:
+        '''
+        Counts a request towards the retry budget.
+        '''
+        with self.lock:
+            self.requests += 1
+
+    def delay(self, kind: str | None, attempt: int,
+              retry_after: float | None = None) -> float | None:
+        '''
+        Seconds to wait before retrying a request that failed on its attempt-th
+        try, or None if it shouldn't be retried.
+        '''
+        backoff = self.backoff.get(kind) if kind is not None else None
+        if backoff is None or attempt >= backoff.max_attempts:
+            return None
+        if retry_after is not None and retry_after > backoff.max_delay:
+            return None
+        with self.lock:
+            if self.retries >= self.min_retries + self.budget_ratio * self.requests:
+                return None
+            self.retries += 1
+        delay = random.uniform(0, min(backoff.max_delay, backoff.base_delay * 2 ** (attempt - 1)))
+        return max(delay, retry_after or 0)
+
+
+class RetryQueue:
+    '''
+    Holds items until their retry time and then hands them to put,
+    from a single background thread.
+    '''
+
+    def __init__(self, put: Callable[[tuple], None]):
+        self.put = put
+        self.heap: list[tuple[float, int, tuple]] = []
+        self.counter = itertools.count()
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def schedule(self, delay: float, item: tuple) -> None:
+        '''
+        Hands item to put after delay seconds.
+        '''
+        with self.condition:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), item))
+            self.pending += 1
+            self.condition.notify_all()
+
+    def wait_empty(self) -> None:
+        '''
+        Blocks until every scheduled item was handed over.
+        '''
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+    def close(self) -> None:
+        '''
+        Stops the thread. Items still waiting are dropped.
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.closed and \
+                      (not self.heap or self.heap[0][0] > time.monotonic()):
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    self.condition.wait(timeout=timeout)
+                if self.closed:
+                    return
+                _, _, item = heapq.heappop(self.heap)
+            self.put(item)
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
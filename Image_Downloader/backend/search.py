@@ -0,0 +1,198 @@
+'''
+Resolves product codes to product page URLs through the supplier search hooks,
+remembering the answers between runs.
+'''
+
+import pathlib
+import sqlite3
+import threading
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SearchMemo:
+    '''
+    Persistent sku -> url memo in a SQLite file.
+
+    Lookups ask for chunk_size skus per query, under SQLite's limit on the
+    number of query parameters.
+
+    Products that weren't found are remembered too, as a None url, but only for
+    negative_ttl seconds, so new products show up on a later run. Found URLs are
+    kept for positive_ttl seconds. Pass None to keep them forever.
+    '''
+
+    chunk_size = 500
+
+    def __init__(self, path: pathlib.Path,
+                 positive_ttl: float | None = 30 * 24 * 3600,
+                 negative_ttl: float | None = 24 * 3600):
+
+        self.path = path
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                '''CREATE TABLE IF NOT EXISTS searches (
+                       sku TEXT PRIMARY KEY,
+                       url TEXT,
+                       searched REAL
+                   )'''
+            )
+
+    def get_many(self, skus: Iterable[str]) -> dict[str, str | None]:
+        '''
+        Returns the remembered answers for the skus that have one that hasn't expired.
+        '''
+        wanted = list(dict.fromkeys(skus))
+        now = time.time()
+        found: dict[str, str | None] = {}
+        rows = []
+        with self.lock:
+            for i in range(0, len(wanted), self.chunk_size):
+                chunk = wanted[i:i + self.chunk_size]
+                marks = ', '.join('?' * len(chunk))
+                rows += self.connection.execute(
+                    f'SELECT sku, url, searched FROM searches WHERE sku IN ({marks})', chunk
+                ).fetchall()
+        for sku, url, searched in rows:
+            ttl = self.positive_ttl if url is not None else self.negative_ttl
+            if ttl is None or now - searched <= ttl:
+                found[sku] = url
+        return found
+
+    def get(self, sku: str) -> tuple[bool, str | None]:
+        '''
+        Returns whether sku has a remembered answer and the answer.
+        '''
+        found = self.get_many([sku])
+        return sku in found, found.get(sku)
+
+    def put_many(self, results: dict[str, str | None]) -> None:
+        '''
+        Remembers the answers.
+        '''
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO searches VALUES (?, ?, ?)',
+                [(sku, url, now) for sku, url in results.items()]
+            )
+
+    def close(self) -> None:
+        '''
+        Closes the database connection.
+        '''
+        with self.lock:
+            self.connection.close()
+
+
+class RateLimiter:
+    '''
+    Spaces calls at least 1/rate seconds apart across threads.
+    '''
+
+    def __init__(self, rate: float | None):
+        self.interval = 0 if not rate else 1 / rate
+        self.lock = threading.Lock()
+        self.next_call = 0.0
+
+    def wait(self) -> None:
+        '''
+        Blocks until the next call is allowed.
+        '''
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SearchResolver:
+    '''
+    Resolves many skus at once. Answers come from the memo when possible, the
+    rest are looked up concurrently on max_workers threads, at most rate calls
+    per second.
+
+    If batch_search is given and batch_size is more than 1, skus are sent in
+    groups of batch_size to batch_search, which returns a dict of the skus it
+    found. Skus missing from that dict count as not found.
+    '''
+
+    def __init__(self, search: Callable[[str], str | None],
+                 memo: SearchMemo,
+                 max_workers: int = 4,
+                 rate: float | None = None,
+                 batch_search: Callable[[list[str]], dict[str, str | None]] | None = None,
+                 batch_size: int = 1):
+
+        self.search = search
+        self.memo = memo
+        self.max_workers = max(1, max_workers)
+        self.limiter = RateLimiter(rate)
+        self.batch_search = batch_search
+        self.batch_size = max(1, batch_size)
+
+    def resolve(self, sku: str) -> str | None:
+        '''
+        Resolves a single sku.
+        '''
+        return self.resolve_many([sku]).get(sku)
+
+    def resolve_many(self, skus: Iterable[str]) -> dict[str, str | None]:
+        '''
+        Resolves every sku. Returns a dict with an entry for each of them.
+        '''
+        unique = list(dict.fromkeys(skus))
+        results = self.memo.get_many(unique)
+        missing = [sku for sku in unique if sku not in results]
+        if not missing:
+            return results
+
+        print(f'Searching for {len(missing)} products, {len(results)} answered from memory')
+        if self.batch_search is not None and self.batch_size > 1:
+            batches = [missing[i:i + self.batch_size]
+                       for i in range(0, len(missing), self.batch_size)]
+            work = self._search_batch
+        else:
+            batches = [[sku] for sku in missing]
+            work = self._search_one
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for found in executor.map(work, batches):
+                results.update(found)
+                self.memo.put_many({sku: url for sku, url in found.items()
+                                    if not isinstance(url, _Failed)})
+        return {sku: (None if isinstance(url, _Failed) else url) for sku, url in results.items()}
+
+    def _search_one(self, batch: list[str]) -> dict:
+        sku = batch[0]
+        self.limiter.wait()
+        try:
+            return {sku: self.search(sku)}
+        except Exception as e: # pylint: disable=broad-exception-caught
+            print(f'Search for {sku} failed: {e}')
+            return {sku: _Failed()}
+
+    def _search_batch(self, batch: list[str]) -> dict:
+        assert self.batch_search is not None
+        self.limiter.wait()
+        try:
+            found = self.batch_search(batch)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            print(f'Search for {len(batch)} products failed: {e}')
+            return {sku: _Failed() for sku in batch}
+        return {sku: found.get(sku) for sku in batch}
+
+
+class _Failed:
+    '''
+    Marks a search that raised, so it isn't remembered as not found.
+    '''
@@ -0,0 +1,110 @@
+'''
+Shared HTTP client used for page fetching, searching and image downloading.
+'''
+
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .throttle import Throttle
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 \
+                    (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36"
+}
+
+
+class HttpClient:
+    '''
+    Wraps a requests.Session that keeps a keep-alive connection pool per host,
+    so repeated requests to the same supplier reuse their TCP/TLS connections.
+
+    pool_connections is the number of hosts to keep pools for and
+    pool_maxsize the number of connections kept open per host. It should be
+    at least as large as the number of threads sharing the client.
+
+    Every request waits for a slot of throttle, which limits the rate and
+    adapts the concurrency per host. See throttle.HostThrottle.
+    '''
+
+    def __init__(self,
+                 pool_connections: int = 10,
+                 pool_maxsize: int = 32,
+                 timeout: float = 10,
+                 headers: dict[str, str] | None = None,
+                 throttle: Throttle | None = None):
+
+        self.timeout = timeout
+        self.throttle = Throttle() if throttle is None else throttle
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS if headers is None else headers)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        '''
+        Same as requests.get but over the pooled session and throttled per host.
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        with self.throttle.slot(url) as ticket:
+            resp = self.session.get(url, **kwargs)
+            ticket.report(resp.status_code, resp.headers)
+        return resp
+
+    @contextmanager
+    def stream(self, url: str, **kwargs) -> Iterator[requests.Response]:
+        '''
+        Same as get with stream=True, but the throttle slot is held until the
+        body is read and the response is closed when the block exits.
+        A timeout or a dropped connection while reading the body counts as a
+        failed request.
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        with self.throttle.slot(url) as ticket:
+            with self.session.get(url, stream=True, **kwargs) as resp:
+                ticket.report(resp.status_code, resp.headers)
+                try:
+                    yield resp
+                except (requests.Timeout, requests.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError) as e:
+                    ticket.error = e
+                    raise
+
+    def close(self) -> None:
+        '''
+        Closes every pooled connection.
+        '''
+        self.session.close()
+
+
+_client: HttpClient | None = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> HttpClient:
+    '''
+    Returns the process wide HttpClient, creating it with the defaults
+    on first use.
+    '''
+    global _client # pylint: disable=global-statement
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
+
+
+def configure(**kwargs) -> HttpClient:
+    '''
+    Replaces the process wide HttpClient with one built from kwargs.
+    Accepts the same arguments as HttpClient.
+    '''
+    global _client # pylint: disable=global-statement
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = HttpClient(**kwargs)
+        return _client
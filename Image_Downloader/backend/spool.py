@@ -0,0 +1,121 @@
+'''
+Streams downloaded images to temporary files instead of holding them in memory.
+'''
+
+import hashlib
+import os
+import pathlib
+import tempfile
+import threading
+
+
+class ImageTooLarge(ValueError):
+    '''
+    Raised when an image is larger than the allowed size.
+    '''
+
+
+class ByteBudget:
+    '''
+    Caps the bytes of the images downloaded but not yet transformed.
+
+    acquire() blocks while the budget is used up. A download that turns out
+    larger than it reserved grows its share without blocking, so downloads
+    already under way never wait on each other.
+    '''
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size: int) -> None:
+        '''
+        Blocks until size bytes fit in the budget. A size larger than the
+        whole budget waits until nothing else is held.
+        '''
+        with self.condition:
+            while self.used and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+
+    def grow(self, size: int) -> None:
+        '''
+        Takes size more bytes without waiting.
+        '''
+        with self.condition:
+            self.used += size
+
+    def release(self, size: int) -> None:
+        '''
+        Gives size bytes back.
+        '''
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class Spool:
+    '''
+    A downloaded image written chunk by chunk to a temporary file in directory,
+    while its sha256 is computed. The bytes are counted against budget until
+    release() is called.
+    '''
+
+    def __init__(self, directory: pathlib.Path, max_size: int | None, budget: ByteBudget):
+        directory.mkdir(parents=True, exist_ok=True)
+        fd, name = tempfile.mkstemp(dir=directory, suffix='.part')
+        self.path = pathlib.Path(name)
+        self.file = os.fdopen(fd, 'wb')
+        self.max_size = max_size
+        self.budget = budget
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.reserved = 0
+
+    def reserve(self, expected: int | None, default: int = 1024 * 1024) -> None:
+        '''
+        Waits for budget for the expected size of the image, or default
+        bytes if the size isn't known. Raises ImageTooLarge if expected
+        is already over max_size.
+        '''
+        if expected is not None and self.max_size is not None and expected > self.max_size:
+            raise ImageTooLarge(f'Image is {expected} bytes, the limit is {self.max_size}')
+        size = default if expected is None else expected
+        self.budget.acquire(size)
+        self.reserved += size
+
+    def write(self, chunk: bytes) -> None:
+        '''
+        Appends a chunk of the body.
+        '''
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise ImageTooLarge(f'Image is larger than {self.max_size} bytes')
+        if self.size > self.reserved:
+            self.budget.grow(self.size - self.reserved)
+            self.reserved = self.size
+        self.file.write(chunk)
+        self.hash.update(chunk)
+
+    def close(self) -> None:
+        '''
+        Finishes writing the file.
+        '''
+        self.file.close()
+
+    @property
+    def digest(self) -> str:
+        '''
+        The sha256 of the body, same as imagestore.content_hash.
+        '''
+        return self.hash.hexdigest()
+
+    def release(self) -> None:
+        '''
+        Deletes the file and gives its bytes back to the budget.
+        '''
+        self.file.close()
+        self.path.unlink(missing_ok=True)
+        self.budget.release(self.reserved)
+        self.reserved = 0
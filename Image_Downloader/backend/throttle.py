@@ -0,0 +1,296 @@
+'''
+Per host rate limiting and adaptive concurrency for every request the program makes.
+'''
+
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+BACKOFF_STATUSES = (429, 503)
+
+
+class Ticket:
+    '''
+    One request holding a slot of a HostThrottle. Report the outcome before
+    the slot is released.
+    '''
+
+    def __init__(self, host: 'HostThrottle'):
+        self.host = host
+        self.started = time.monotonic()
+        self.status: int | None = None
+        self.retry_after: float | None = None
+        self.error: BaseException | None = None
+
+    def report(self, status: int, headers=None) -> None:
+        '''
+        Records the response status, and the Retry-After header if there is one.
+        '''
+        self.status = status
+        if headers is not None and status in BACKOFF_STATUSES:
+            self.retry_after = parse_retry_after(headers.get('Retry-After'))
+
+
+class HostThrottle:
+    '''
+    Limits the requests to a single host in two ways.
+
+    A token bucket allows at most rate requests per second, with bursts of up
+    to burst requests. Pass rate=None to only limit the concurrency.
+
+    The number of requests in flight is adjusted AIMD style, between
+    min_concurrency and max_concurrency. Every successful response with a
+    latency under latency_tolerance times the best latency seen adds about
+    one slot per limit responses. A 429 or 503, a timeout or a connection
+    error halves the limit, at most once per backoff_interval seconds, and a
+    Retry-After header pauses the host, for at most max_pause seconds.
+    '''
+
+    def __init__(self, rate: float | None = 50,
+                 burst: int = 10,
+                 initial_concurrency: int = 4,
+                 min_concurrency: int = 1,
+                 max_concurrency: int = 32,
+                 latency_tolerance: float = 2.0,
+                 backoff_interval: float = 1.0,
+                 max_pause: float = 120.0):
+
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.refilled = time.monotonic()
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency)
+        self.limit = float(min(max(initial_concurrency, self.min_concurrency), self.max_concurrency))
+        self.latency_tolerance = latency_tolerance
+        self.backoff_interval = backoff_interval
+        self.max_pause = max_pause
+        self.in_flight = 0
+        self.best_latency: float | None = None
+        self.paused_until = 0.0
+        self.last_backoff = 0.0
+        self.condition = threading.Condition()
+
+    def _try_acquire(self) -> float:
+        '''
+        Takes a slot and a token if both are available and returns 0.
+        Otherwise returns how long to wait before trying again.
+        '''
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.in_flight >= int(self.limit):
+            return 0.05
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.in_flight += 1
+        return 0
+
+    def acquire(self) -> Ticket:
+        '''
+        Blocks until a request to the host is allowed.
+        '''
+        with self.condition:
+            while (wait := self._try_acquire()) > 0:
+                self.condition.wait(timeout=wait)
+        return Ticket(self)
+
+    async def acquire_async(self) -> Ticket:
+        '''
+        Waits on the event loop until a request to the host is allowed.
+        '''
+        while True:
+            with self.condition:
+                wait = self._try_acquire()
+            if wait == 0:
+                return Ticket(self)
+            await asyncio.sleep(wait)
+
+    def release(self, ticket: Ticket) -> None:
+        '''
+        Frees the slot and adapts the limits to the outcome of the request.
+        '''
+        latency = time.monotonic() - ticket.started
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if ticket.error is not None or ticket.status in BACKOFF_STATUSES:
+                if now - self.last_backoff >= self.backoff_interval:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self.last_backoff = now
+                if ticket.retry_after:
+                    self.paused_until = max(self.paused_until, now + min(ticket.retry_after, self.max_pause))
+            elif ticket.status is not None:
+                if self.best_latency is None or latency < self.best_latency:
+                    self.best_latency = latency
+                if latency <= self.best_latency * self.latency_tolerance:
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class SharedLimit:
+    '''
+    A number of slots shared by threads and event loops. Waiters get the
+    released slots in the order they asked for them, without polling.
+    '''
+
+    def __init__(self, limit: int):
+        self.free = max(1, limit)
+        self.lock = threading.Lock()
+        self.waiters: deque[tuple[asyncio.AbstractEventLoop | None, threading.Event | asyncio.Future]] = deque()
+
+    def acquire(self) -> None:
+        '''
+        Blocks the thread until a slot is free.
+        '''
+        with self.lock:
+            if self.free and not self.waiters:
+                self.free -= 1
+                return
+            event = threading.Event()
+            self.waiters.append((None, event))
+        # release() hands its slot straight to the waiter
+        event.wait()
+
+    async def acquire_async(self) -> None:
+        '''
+        Waits on the event loop until a slot is free.
+        '''
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.free and not self.waiters:
+                self.free -= 1
+                return
+            future = loop.create_future()
+            self.waiters.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.lock:
+                if (loop, future) in self.waiters:
+                    self.waiters.remove((loop, future))
+                    raise
+            if future.done() and not future.cancelled():
+                # The slot was handed over just before the cancellation
+                self.release()
+            raise
+
+    def release(self) -> None:
+        '''
+        Frees a slot, or hands it to the first waiter.
+        '''
+        with self.lock:
+            if not self.waiters:
+                self.free += 1
+                return
+            loop, waiter = self.waiters.popleft()
+        if loop is None:
+            waiter.set() # type: ignore
+        else:
+            loop.call_soon_threadsafe(self._hand_over, waiter)
+
+    def _hand_over(self, future: asyncio.Future) -> None:
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class Throttle:
+    '''
+    Keeps a HostThrottle for every host. The keyword arguments are passed to
+    each new HostThrottle.
+
+    max_in_flight caps the requests in flight to all the hosts together, for
+    when several suppliers run at once. None leaves it to the hosts' limits.
+    A request takes its host's slot first, so requests waiting on a slow or
+    throttled host don't hold the shared slots the other hosts need.
+    '''
+
+    def __init__(self, max_in_flight: int | None = None, **host_settings):
+        self.host_settings = host_settings
+        self.hosts: dict[str, HostThrottle] = {}
+        self.lock = threading.Lock()
+        self.total = SharedLimit(max_in_flight) if max_in_flight is not None else None
+
+    def host(self, url: str) -> HostThrottle:
+        '''
+        The HostThrottle for the host of url.
+        '''
+        netloc = urlparse(url).netloc
+        with self.lock:
+            if netloc not in self.hosts:
+                self.hosts[netloc] = HostThrottle(**self.host_settings)
+            return self.hosts[netloc]
+
+    @contextmanager
+    def slot(self, url: str):
+        '''
+        Holds a slot for a request to url. Exceptions raised in the block
+        before a status was reported count as failed requests.
+        '''
+        host = self.host(url)
+        ticket = host.acquire()
+        try:
+            if self.total is not None:
+                self.total.acquire()
+                # The host's latency doesn't include the wait for the shared slot
+                ticket.started = time.monotonic()
+            try:
+                yield ticket
+            finally:
+                if self.total is not None:
+                    self.total.release()
+        except Exception as e:
+            if ticket.status is None:
+                ticket.error = e
+            raise
+        finally:
+            host.release(ticket)
+
+    @asynccontextmanager
+    async def slot_async(self, url: str):
+        '''
+        The asyncio version of slot.
+        '''
+        host = self.host(url)
+        ticket = await host.acquire_async()
+        try:
+            if self.total is not None:
+                await self.total.acquire_async()
+                ticket.started = time.monotonic()
+            try:
+                yield ticket
+            finally:
+                if self.total is not None:
+                    self.total.release()
+        except Exception as e:
+            if ticket.status is None:
+                ticket.error = e
+            raise
+        finally:
+            host.release(ticket)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    '''
+    Seconds to wait according to a Retry-After header, given in seconds or as a date.
+    '''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
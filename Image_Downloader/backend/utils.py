@@ -3,13 +3,18 @@ Utility functions
 """
 
 
+import multiprocessing
+import os
 import pathlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-from zipfile import ZipFile
 from datetime import datetime
-import shutil
 
-from PIL import Image
+from .archive import ArchiveManifest, ArchiveWriter
+from .journal import RunJournal
+from .results import ResultStore
+from .verify import VerificationIndex, verify_image
 
 class Integrity(Enum):
     """
@@ -22,11 +27,21 @@ class Integrity(Enum):
 class IntegrityChecker():
     """
     Checks downloaded images for integrity, failed requests and other issues.
+    Failed downloads are read from the downloader's results.sqlite.
+
+    Images that passed are remembered in verified.sqlite by size, modification
+    time and hash, so only new or changed images are verified, on a pool of
+    processes processes (defaults to the number of cores). Images the
+    downloader verified right after transforming them aren't checked again.
     """
 
+    # Below this many images the process pool costs more than it saves
+    pool_threshold = 64
+
     def __init__(self, supplier_path: pathlib.Path,
                  mode: Integrity = Integrity.BOTH,
-                 log = False):
+                 log = False,
+                 processes: int | None = None):
 
         self.app_path = supplier_path
         self.image_path = self.app_path / 'images'
@@ -35,24 +50,40 @@ class IntegrityChecker():
         self.integrity_check_passed = True
         self.download_check_passed = True
 
+        #check if downloaded
+        results_path = self.app_path / 'results.sqlite'
+        if results_path.exists():
+            results = ResultStore(results_path)
+            for failure in results.failures():
+                self.download_check_passed = False
+                self.failed_files.append({'name': failure['filename'], 'reason': failure})
+            results.close()
+
+        images = []
         for file in self.files:
 
-            #check if downloaded
+            #failure logs left by older versions
             if file.name.startswith('Failed'):
                 self.download_check_passed = False
                 with file.open() as f:
                     self.failed_files.append({'name': file.name, 'reason': f.read()})
-
-
-            #check integrity
-            try:
-                image = Image.open(file)
-                image.verify()
-            except OSError as e:
-                self.integrity_check_passed = False
-                self.failed_files.append(
-                    {'name': file.name, 'reason': f'Integrity Check Failed, {e}'}
-                )
+                continue
+            images.append(file)
+
+        #check integrity
+        index = VerificationIndex(self.app_path / 'verified.sqlite')
+        unverified = index.unverified(images)
+        passed = []
+        for file, (error, digest) in zip(unverified, self._verify(unverified, processes)):
+            if error is None:
+                passed.append((file, digest))
+                continue
+            self.integrity_check_passed = False
+            self.failed_files.append(
+                {'name': file.name, 'reason': f'Integrity Check Failed, {error}'}
+            )
+        index.add_many(passed)
+        index.close()
 
 
         match mode:
@@ -63,6 +94,15 @@ class IntegrityChecker():
         if log:
             self.write_to_log()
 
+    def _verify(self, files: list[pathlib.Path], processes: int | None):
+        if len(files) < self.pool_threshold or processes == 1:
+            return [verify_image(file) for file in files]
+        processes = processes or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=processes,
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            return list(pool.map(verify_image, files,
+                                 chunksize=max(1, len(files) // (processes * 4))))
+
     def write_to_log(self):
         """
         Logs the result to notify the client.
@@ -81,23 +121,53 @@ class IntegrityChecker():
 class Archiver:
     '''
     Handles archiving for downloaded images and logs.
+
+    The archive is written by an ArchiveWriter in the background. Images can be
+    handed to add() as soon as they are downloaded, for example by passing it as
+    the downloader's on_image, so the archive is mostly written by the time the
+    run ends. run() adds the images that weren't added yet and the logs.
+
+    The archive is split in volumes of volume_size bytes, if given, and the
+    volumes are written straight to destination, the working directory by
+    default, so they never need to be copied.
+
+    By default the images are deleted once archived. With incremental set they
+    are kept, so the next run doesn't download them again, and every archive
+    only has the images that are new or changed since the last one, by their
+    sha256 as kept in archive_manifest.sqlite, and a removed.txt listing the
+    images that were archived before but are no longer in links.txt. Images no
+    longer in links.txt are deleted. Both only concern products that were scraped
+    this run, whose SKU has links in links.txt, so a product whose page failed
+    keeps its images until a run finds it again.
     '''
 
     def __init__(self,
                  supplier_path: pathlib.Path,
                  name: str = ..., # type: ignore
-                 integrity: bool | IntegrityChecker = ... # type: ignore
+                 integrity: bool | IntegrityChecker = ..., # type: ignore
+                 volume_size: int | None = None,
+                 compresslevel: int = 6,
+                 destination: pathlib.Path | None = None,
+                 incremental: bool = False
                 ):
 
         self.app_path = supplier_path
         self.image_path = self.app_path / 'images'
         self.time: str = datetime.now().strftime('%Y%m%d')
-        self.files = self.image_path.iterdir()
         self.log_files = ['integrity_log.txt', 'logs.txt', 'links.txt']
         self.name = 'ImageArchive' if name is Ellipsis else name
         self.integrity = bool(integrity)
-        self.zip_name = str(self.app_path.absolute() / f'{self.name}-{self.time}.zip')
-        
+        self.volume_size = volume_size
+        self.compresslevel = compresslevel
+        self.destination = pathlib.Path.cwd() if destination is None else destination
+        self.manifest = ArchiveManifest(self.app_path / 'archive_manifest.sqlite') \
+                        if incremental else None
+        self.volumes: list[pathlib.Path] = []
+        self._writer: ArchiveWriter | None = None
+        self._added: dict[str, tuple[pathlib.Path, str | None]] = {}
+        # Every image seen this run, added or found unchanged
+        self._checked: set[str] = set()
+        self._lock = threading.Lock()
 
 
     def run(self):
@@ -108,29 +178,109 @@ class Archiver:
         if not self.integrity:
             print('The integrity check failed. \
                   Check the integrity_log.txt for issues or override the integrity check')
+            with self._lock:
+                if self._writer is not None:
+                    self._writer.discard()
+                    self._writer = None
+                self._added.clear()
+                self._checked.clear()
             return
         self.make_archive()
 
 
+    def add(self, image: pathlib.Path) -> None:
+        '''
+        Queues a finished image for the archive. Safe to call from many threads.
+        In incremental mode, images that didn't change since the last archive are left out.
+        '''
+        with self._lock:
+            if image.name in self._checked:
+                return
+            self._checked.add(image.name)
+        digest = None
+        if self.manifest is not None:
+            digest = self.manifest.changed(image)
+            if digest is None:
+                return
+        with self._lock:
+            self._added[image.name] = (image, digest)
+            self._open_writer().add(image)
+
+
     def make_archive(self):
         """
         Turns the images to a .zip file for easier transmission.
         """
 
-        with ZipFile(self.zip_name, 'w') as zipfile:
-
-            for file in self.files:
-                zipfile.write(str(file), file.name)
-
-            for filename in self.log_files:
-                file = self.app_path / filename
-                zipfile.write(str(file), file.name)
-
-        images = self.image_path.iterdir()
+        resolved: set[str] = set()
+        if self.manifest is not None:
+            resolved = self._prune()
+        images = list(self.image_path.iterdir())
         for image in images:
-            image.unlink()
-        cwd = pathlib.Path.cwd()
-        shutil.copy(self.zip_name, str(cwd.absolute()))
+            self.add(image)
+
+        with self._lock:
+            writer = self._open_writer()
+            self._writer = None
+            added = list(self._added.values())
+            self._added.clear()
+            self._checked.clear()
+        removed: list[str] = []
+        if self.manifest is not None:
+            names = {image.name for image in images}
+            removed = sorted(name for name in self.manifest.known
+                             if name not in names and sku_of(name) in resolved)
+            removed_file = self.app_path / 'removed.txt'
+            removed_file.write_text(''.join(f'{name}\n' for name in removed))
+            writer.add(removed_file)
+        for filename in self.log_files:
+            file = self.app_path / filename
+            if file.exists():
+                writer.add(file)
+        self.volumes = writer.close()
+
+        if writer.errors:
+            print(f'{len(writer.errors)} files could not be archived, the images are kept')
+            return
+        if self.manifest is not None:
+            self.manifest.update([(image, digest) for image, digest in added if digest], removed)
+            print(f'{len(added)} new or changed images, {len(removed)} removed')
+        else:
+            for image in images:
+                image.unlink()
+        for volume in self.volumes:
+            print(f'Archived to {volume}')
+
+
+    def _open_writer(self) -> ArchiveWriter:
+        if self._writer is None:
+            self._writer = ArchiveWriter(self.destination, f'{self.name}-{self.time}',
+                                         self.volume_size, self.compresslevel)
+        return self._writer
+
+
+    def _prune(self) -> set[str]:
+        '''
+        Deletes the images of the products scraped this run that are no
+        longer in links.txt. Returns the SKUs of those products.
+        '''
+        links = self.app_path / 'links.txt'
+        if not links.exists():
+            return set()
+        with links.open() as f:
+            names = {line.split('|')[0] for line in f if '|' in line}
+        resolved = {sku_of(name) for name in names}
+        for image in self.image_path.iterdir():
+            if image.name not in names and sku_of(image.name) in resolved:
+                image.unlink()
+        return resolved
+
+
+def sku_of(filename: str) -> str:
+    '''
+    The SKU of an image named like the page getters name them, [sku]_[number].[ext].
+    '''
+    return filename.rsplit('_', maxsplit=1)[0]
 
 
 def archive_data(supplier_path: pathlib.Path) -> None:
@@ -170,10 +320,47 @@ def show_image_links(supplier_path: pathlib.Path) -> str:
         return f'Links file not found for supplier {supplier_path.name}, {e}'
 
 
-def check_process() -> str:
+def run_progress(supplier_path: pathlib.Path) -> dict:
+    """
+    The progress of the last run of the supplier, read from its journal.sqlite.
+    For every stage that ran, whether it finished and how many products or
+    images are in each state, and the number of image links found so far.
+    """
+    progress: dict = {}
+    journal_path = supplier_path / 'journal.sqlite'
+    if journal_path.exists():
+        journal = RunJournal(journal_path)
+        try:
+            for stage in ('scrape', 'download'):
+                stage_progress = journal.progress(stage)
+                if stage_progress is not None:
+                    finished, counts = stage_progress
+                    progress[stage] = {'finished': finished, **counts}
+        finally:
+            journal.close()
+    links = supplier_path / 'links.txt'
+    if links.exists():
+        with links.open() as f:
+            progress['links'] = sum(1 for line in f if line.strip())
+    return progress
+
+
+def check_process(supplier_path: pathlib.Path) -> str:
     """
-    Arguments 'supplier_path: pathlib.Path'
-    Checks if the Downloader process and returns the appropriate message.
+    Checks the progress of the Downloader process and returns the appropriate message.
     """
-    return 'Not Implemented Yet'
+    progress = run_progress(supplier_path)
+    lines = []
+    for stage, name in (('scrape', 'Scraping'), ('download', 'Downloading')):
+        if stage not in progress:
+            continue
+        counts = dict(progress[stage])
+        status = 'finished' if counts.pop('finished') else 'in progress'
+        details = ', '.join(f'{count} {state}' for state, count in sorted(counts.items()))
+        lines.append(f'{name} {status}: {details or "nothing yet"}')
+    if not lines:
+        return f'No runs found for supplier {supplier_path.name}'
+    if 'links' in progress:
+        lines.append(f"{progress['links']} image links")
+    return '\n'.join(lines)
     
\ No newline at end of file
@@ -0,0 +1,112 @@
+'''
+Image verification shared by the downloader and the IntegrityChecker.
+'''
+
+import hashlib
+import io
+import pathlib
+import sqlite3
+import threading
+from collections.abc import Iterable
+
+from PIL import Image
+
+
+def check_image(content: bytes) -> None:
+    '''
+    Raises OSError if content isn't a valid image.
+    '''
+    with Image.open(io.BytesIO(content)) as image:
+        image.verify()
+
+
+def verify_image(path: pathlib.Path) -> tuple[str | None, str]:
+    '''
+    Verifies the image at path. Returns the error, or None if the
+    image is fine, and the sha256 of the file.
+    '''
+    content = path.read_bytes()
+    digest = hashlib.sha256(content).hexdigest()
+    try:
+        check_image(content)
+    except (OSError, SyntaxError, ValueError) as e:
+        return str(e), digest
+    return None, digest
+
+
+class VerificationIndex:
+    '''
+    Remembers the images that passed verification by size, modification
+    time and hash, in a SQLite file, so they aren't verified again.
+    '''
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                '''CREATE TABLE IF NOT EXISTS verified (
+                       name TEXT PRIMARY KEY,
+                       size INTEGER,
+                       mtime INTEGER,
+                       hash TEXT
+                   )'''
+            )
+
+    def add(self, file: pathlib.Path, digest: str | None = None) -> None:
+        '''
+        Records file as verified. Without a digest, a later change of its
+        modification time means it's verified again.
+        '''
+        self.add_many([(file, digest)])
+
+    def add_many(self, files: Iterable[tuple[pathlib.Path, str | None]]) -> None:
+        '''
+        Records many files as verified.
+        '''
+        rows = []
+        for file, digest in files:
+            stat = file.stat()
+            rows.append((file.name, stat.st_size, stat.st_mtime_ns, digest))
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?)', rows)
+
+    def unverified(self, files: Iterable[pathlib.Path]) -> list[pathlib.Path]:
+        '''
+        The files that are new or changed since they were verified. A file
+        whose modification time changed but whose hash didn't isn't returned.
+        '''
+        with self.lock:
+            known = {name: (size, mtime, digest) for name, size, mtime, digest
+                     in self.connection.execute('SELECT * FROM verified')}
+        changed = []
+        touched = []
+        for file in files:
+            stat = file.stat()
+            size, mtime, digest = known.get(file.name, (None, None, None))
+            if size == stat.st_size and mtime == stat.st_mtime_ns:
+                continue
+            if size == stat.st_size and digest is not None and \
+               hashlib.sha256(file.read_bytes()).hexdigest() == digest:
+                touched.append((file, digest))
+                continue
+            changed.append(file)
+        if touched:
+            self.add_many(touched)
+        return changed
+
+    def remove(self, file: pathlib.Path) -> None:
+        '''
+        Forgets file.
+        '''
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM verified WHERE name = ?', (file.name,))
+
+    def close(self) -> None:
+        '''
+        Closes the database connection.
+        '''
+        with self.lock:
+            self.connection.close()
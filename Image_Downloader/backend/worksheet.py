@@ -4,25 +4,40 @@
 Handles file IO for the downloader.
 '''
 
+import hashlib
 import pathlib
 import sys
 from tkinter.filedialog import askopenfilename
 import pandas as pd
+from openpyxl import load_workbook
 
 class WorksheetImporter:
     '''
     Handles IO for excel files.
+
+    Besides xlsx it also reads csv and parquet files. When columns is given
+    only those columns are read; xlsx files are then streamed row by row in
+    openpyxl's read only mode instead of being loaded whole.
+
+    The parsed table is cached in the .worksheet_cache directory, keyed by the
+    hash of the file and the columns, so running again on the same file
+    doesn't parse it again. Only the most recent cache_size tables are kept.
     '''
 
+    cache_size = 5
 
-    def __init__(self, supplier_path: pathlib.Path):
+    def __init__(self, supplier_path: pathlib.Path, columns: list[str] | None = None,
+                 filename: str | None = None):
         self.worksheet: pd.DataFrame
         self.basedir = supplier_path
-        self.read_excel = lambda x: pd.read_excel(x, dtype=object)
-        # Try to get file from argv
-        if len(sys.argv) == 3:
+        self.columns = columns
+        self.cache_path = self.basedir / '.worksheet_cache'
+        # Try to get file from the caller, then argv
+        if filename is None and len(sys.argv) == 3:
+            filename = sys.argv[2]
+        if filename is not None:
             try:
-                self.worksheet = self.read_excel(sys.argv[2])
+                self.worksheet = self.read_excel(filename)
             except IOError as e:
                 print(e)
                 sys.exit(1)
@@ -39,3 +54,74 @@ class WorksheetImporter:
             else:
                 print("Please select a file")
                 self.worksheet = self.read_excel(askopenfilename(title="Please select a file", initialdir=str(data_path)))
+
+    def read_excel(self, filename: str) -> pd.DataFrame:
+        '''
+        Reads the worksheet, or loads it from the cache if the file was read before.
+        '''
+        path = pathlib.Path(filename)
+        cached = self.cache_path / f'{self._cache_key(path)}.pkl'
+        if cached.exists():
+            print(f'Loading {path.name} from the worksheet cache')
+            return pd.read_pickle(cached)
+
+        worksheet = read_table(path, self.columns)
+        self.cache_path.mkdir(exist_ok=True)
+        worksheet.to_pickle(cached)
+        self._prune_cache()
+        return worksheet
+
+    def _cache_key(self, path: pathlib.Path) -> str:
+        digest = hashlib.sha256()
+        with path.open('rb') as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+        digest.update(repr(self.columns).encode())
+        return digest.hexdigest()
+
+    def _prune_cache(self) -> None:
+        cached = sorted(self.cache_path.glob('*.pkl'), key=lambda file: file.stat().st_mtime)
+        for file in cached[:-self.cache_size]:
+            file.unlink(missing_ok=True)
+
+
+def read_table(path: pathlib.Path, columns: list[str] | None = None) -> pd.DataFrame:
+    '''
+    Reads an xlsx, xls, csv or parquet file with every value as object,
+    keeping only columns if given. Parquet needs the optional pyarrow dependency.
+    '''
+    match path.suffix.lower():
+        case '.csv':
+            return pd.read_csv(path, dtype=object, usecols=columns)
+        case '.parquet':
+            try:
+                return pd.read_parquet(path, columns=columns).astype(object)
+            except ImportError as e:
+                raise ImportError('Reading parquet files requires pyarrow. '
+                                  'Install it with pip install Image_Downloader[parquet]') from e
+        case '.xlsx' | '.xlsm' if columns is not None:
+            return _read_xlsx_columns(path, columns)
+        case _:
+            return pd.read_excel(path, dtype=object, usecols=columns)
+
+
+def _read_xlsx_columns(path: pathlib.Path, columns: list[str]) -> pd.DataFrame:
+    '''
+    Streams the first sheet of an xlsx file and keeps only columns.
+    '''
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [str(cell) if cell is not None else '' for cell in next(rows, ())]
+        missing = [column for column in columns if column not in header]
+        if missing:
+            raise KeyError(f'Columns {missing} not found in {path.name}')
+        indices = [header.index(column) for column in columns]
+        data = [
+            [row[i] if i < len(row) else None for i in indices]
+            for row in rows
+            if any(cell is not None for cell in row)
+        ]
+    finally:
+        workbook.close()
+    return pd.DataFrame(data, columns=columns, dtype=object)
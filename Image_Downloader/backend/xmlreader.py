@@ -3,34 +3,100 @@ Searches image links in Product pages.
 '''
 
 import sys
+from collections.abc import Iterator
 from io import TextIOWrapper
 from pathlib import Path
 from abc import abstractmethod
+from xml.etree import ElementTree
 
 import pandas as pd
 
 class XmlReader:
     '''
-    Handles XML files and either turns them in 
+    Handles XML files and either turns them in
     dataframes, or just dumps the links in links.txt
+
+    By default the feed is streamed. Each product_node element is parsed,
+    handed to parse_product as a dict and dropped, so memory stays flat no
+    matter how large the feed is, and links.txt is written as it goes.
+    Pass stream=False to read the whole file and use create_worksheet and
+    create_links_txt instead.
     '''
 
     def __init__(self, supplier_path: str | Path,
                  product_node: str,
-                 filename: TextIOWrapper | str | None):
+                 filename: TextIOWrapper | str | None,
+                 stream: bool = True):
 
         # Initialize supplier_path
         self.supplier_path = supplier_path
         self.filename = filename
-
-        if len(sys.argv) == 3:
-            with open(sys.argv[2], encoding='utf8') as f:
-                self.file_contents = f.read()
+        # The file given by the caller, or the one on argv
+        if filename is None and len(sys.argv) == 3:
+            self.source = sys.argv[2]
+        else:
+            self.source = filename
         self.product_node = product_node
         self.worksheet: pd.DataFrame | None = None
+
+        if stream:
+            self.write_links()
+            return
+
+        if isinstance(self.source, TextIOWrapper):
+            self.file_contents = self.source.read()
+        else:
+            with open(str(self.source), encoding='utf8') as f:
+                self.file_contents = f.read()
         self.create_worksheet(self.file_contents, self.product_node)
         self.create_links_txt(self.file_contents, self.product_node)
 
+    def iter_products(self) -> Iterator[dict]:
+        '''
+        Yields every product_node element of the feed as a dict, in the shape
+        xmltodict would give it. Each element is removed from the tree after
+        it's been yielded.
+        '''
+        source = self.source
+        if source is None:
+            raise ValueError('No XML feed was given')
+        if not isinstance(source, TextIOWrapper):
+            source = str(source)
+
+        stack: list[ElementTree.Element] = []
+        for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                stack.append(element)
+                continue
+            stack.pop()
+            if element.tag != self.product_node:
+                continue
+            yield _element_to_dict(element)
+            if stack:
+                stack[-1].remove(element)
+            else:
+                element.clear()
+
+    def write_links(self) -> None:
+        '''
+        Streams the feed into links.txt, one product at a time.
+        '''
+        with (Path(self.supplier_path) / 'links.txt').open('w') as f:
+            for product in self.iter_products():
+                sku, links = self.parse_product(product)
+                if not sku:
+                    continue
+                for i, link in enumerate(links):
+                    ext = link.rsplit('.', maxsplit=1)[-1] if '.' in link else 'jpg'
+                    f.write(f'{sku}_{i}.{ext}|{link}\n')
+
+    @abstractmethod
+    def parse_product(self, product: dict) -> tuple[str | None, list[str]]:
+        '''
+        Abstract method that returns the sku and the image links of
+        a product node. Used when the feed is streamed.
+        '''
+
     @abstractmethod
     def create_worksheet(self, file_contents, product_node) -> None:
         '''
@@ -46,6 +112,27 @@ class XmlReader:
         '''
 
 
+def _element_to_dict(element: ElementTree.Element) -> dict | str | None:
+    '''
+    Converts an element to nested dicts. Leaf elements become their text and
+    repeated tags become lists, like xmltodict does.
+    '''
+    if len(element) == 0 and not element.attrib:
+        return element.text.strip() if element.text and element.text.strip() else None
+
+    result: dict = {f'@{key}': value for key, value in element.attrib.items()}
+    for child in element:
+        value = _element_to_dict(child)
+        if child.tag in result:
+            if not isinstance(result[child.tag], list):
+                result[child.tag] = [result[child.tag]]
+            result[child.tag].append(value)
+        else:
+            result[child.tag] = value
+    if element.text and element.text.strip():
+        result['#text'] = element.text.strip()
+    return result
+
 
 if __name__ == '__main__':
     reader = XmlReader('asdf', 'Product', 'Image_Downloader/artelibre/data')
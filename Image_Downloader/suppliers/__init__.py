@@ -0,0 +1,11 @@
+'''
+The supplier scripts. The directories in the IMAGE_DOWNLOADER_SUPPLIERS
+environment variable, separated by os.pathsep, are searched for more of them.
+'''
+
+import os
+
+SUPPLIERS_ENV = 'IMAGE_DOWNLOADER_SUPPLIERS'
+
+# Read at import, so the processes a job spawns find the same suppliers
+__path__.extend(path for path in os.environ.get(SUPPLIERS_ENV, '').split(os.pathsep) if path)
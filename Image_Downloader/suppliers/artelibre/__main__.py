@@ -8,11 +8,11 @@ import sys
 import os
 from pathlib import Path
 
-import xmltodict
-
 from ...backend.xmlreader import XmlReader
 from ...backend.downloader import ImageDownloader
 from ...backend.utils import IntegrityChecker, Archiver
+from ...backend.pipeline import run_pipeline
+from ...backend.resources import SharedResources
 from ...backend.poonto.imagecropper import resize_image
 
 supplier_path = Path(__file__).parent
@@ -26,9 +26,12 @@ class SupplierImageDownloader(ImageDownloader):
     Standard Poonto image transformation.
     '''
 
+    transform_key = 'poonto-resize'
+    transform_params = {'dimensions': (740, 740)}
+
     def transform_image(self, image: bytes, filename: str) -> bytes:
         ext = filename.rsplit('.', maxsplit=1)[-1]
-        return resize_image(image, (740, 740), ext)
+        return resize_image(image, extension=ext, **self.transform_params)
 
 class SupplierXMLreader(XmlReader):
 
@@ -39,56 +42,39 @@ class SupplierXMLreader(XmlReader):
     def create_worksheet(self, file_contents, product_node) -> None:
         raise NotImplementedError()
 
-    def _traverse_dict(self, _dict, product_node) -> list[dict]:
-        stack = [_dict]
-        while stack:
-            _dict = stack.pop()
-            if product_node in _dict:
-                data = _dict[product_node]
-            else:
-                for key in _dict.keys():
-                    stack.append(_dict[key])
-
-        if data is None:
-            raise KeyError()
-        if not isinstance(data, list):
-            raise ValueError()
-        return data
-
-    def create_links_txt(self, file_contents: str, product_node: str):
-        _dict = xmltodict.parse(file_contents)
-        data = self._traverse_dict(_dict, product_node)
-        entries = []
-        for item in data:
-            sku = item.get('sku')
-            images = item.get('images')
-            entries.append((sku, images))
-
-        stringbuffer = ''
-        for sku, image_dict in entries:
-            if not (sku or images):
-                continue
-            images = image_dict['image']
-            if isinstance(images, str):
-                stringbuffer += f'{sku}_0|{images}\n'
-            elif isinstance(images, list):
-                for i, image in enumerate(images):
-                    stringbuffer += f"{sku}_{i}|{image}\n"
-
-        with (supplier_path / 'links.txt').open('w') as f:
-            f.write(stringbuffer)
-
-
-def main():
+    def parse_product(self, product: dict) -> tuple[str | None, list[str]]:
+        sku = product.get('sku')
+        image_dict = product.get('images')
+        if not isinstance(image_dict, dict):
+            return sku, []
+        images = image_dict.get('image')
+        if isinstance(images, str):
+            return sku, [images]
+        if isinstance(images, list):
+            return sku, [image for image in images if image]
+        return sku, []
+
+
+def main(engine: str = 'threads', stream: bool = True, incremental: bool = False,
+         filename: str | None = None, resources: SharedResources | None = None):
 
     '''
     Is called by the controller.py script. Don't attempt to run as top level.
+    engine is either 'threads' or 'async'. stream has no effect, as the
+    links come straight from the feed.
+    incremental keeps the images and archives only what changed since the last run.
+    filename is the file to read instead of the one on the command line, and
+    resources the pools shared with other suppliers running at the same time.
     '''
 
-    _ = SupplierXMLreader(supplier_path, 'Product', None)
-    SupplierImageDownloader(supplier_path=supplier_path).run()
+    _ = SupplierXMLreader(supplier_path, 'Product', filename)
+    archiver = Archiver(supplier_path, 'Artelibre', incremental=incremental)
+    downloader = SupplierImageDownloader(supplier_path=supplier_path, on_image=archiver.add,
+                                         resources=resources)
+    run_pipeline(None, downloader, engine=engine, stream=stream)
     ic = IntegrityChecker(log=True, supplier_path=supplier_path)
-    Archiver(supplier_path, 'Artelibre', ic).run()
+    archiver.integrity = bool(ic)
+    archiver.run()
 
 
 if __name__ == '__main__':
@@ -6,16 +6,19 @@ A script meant to spawned as a process from the controller.py script.
 
 import sys
 import os
+from functools import partial
 from pathlib import Path
 
-import requests
 from bs4 import BeautifulSoup
 
 from ...backend.pagegetter import ProductPageGetter
 from ...backend.worksheet import WorksheetImporter
 from ...backend.downloader import ImageDownloader
 from ...backend.utils import IntegrityChecker, Archiver
+from ...backend.pipeline import run_pipeline
+from ...backend.resources import SharedResources
 from ...backend.poonto.imagecropper import resize_image
+from ...backend.poonto.kentia.remove_new import remove_new
 
 supplier_path = Path(__file__).parent
 app_path = supplier_path.parent.parent.parent
@@ -36,14 +39,14 @@ class SupplierPageGetter(ProductPageGetter):
 
         try:
 
-            resp = requests.get(self.search_api.format(sku), timeout=20)
+            resp = self.http.get(self.search_api.format(sku), timeout=20)
             resp.raise_for_status()
             data = resp.json()
             results = data['products'][0]
             url = results['url']
             return url
 
-        except (requests.HTTPError, TypeError) as e:
+        except (IndexError, TypeError) as e:
 
             e.add_note('Product page not found')
             return None
@@ -60,27 +63,46 @@ class SupplierPageGetter(ProductPageGetter):
 class SupplierImageDownloader(ImageDownloader):
 
     '''
-    Standard Poonto image transformation.
+    Standard Poonto image transformation, after cropping the
+    [NEW] stamp off the images that have it. The crop and the
+    resize share a single decode of the image.
     '''
 
+    transform_key = 'kentia-remove-new-resize'
+    transform_params = {'dimensions': (740, 740), 'stamp_tolerance': 5}
+
     def transform_image(self, image: bytes, filename: str) -> bytes:
         ext = filename.rsplit('.', maxsplit=1)[-1]
-        return resize_image(image, (740, 740), ext)
+        params = dict(self.transform_params)
+        stamp_tolerance = params.pop('stamp_tolerance')
+        return resize_image(image, extension=ext,
+                            prepare=partial(remove_new, tolerance=stamp_tolerance), **params)
 
 
-def main():
+def main(engine: str = 'threads', stream: bool = True, incremental: bool = False,
+         filename: str | None = None, resources: SharedResources | None = None):
     '''
     The function to be called by controller.py.
     Don't attempt to run as top level.
+
+    engine is either 'threads' or 'async'.
+    stream downloads the images while the pages are still being scraped.
+    incremental keeps the images and archives only what changed since the last run.
+    filename is the file to read instead of the one on the command line, and
+    resources the pools shared with other suppliers running at the same time.
     '''
 
-    ws = WorksheetImporter(supplier_path=supplier_path).worksheet
-    SupplierPageGetter(ws, supplier_path,
-                       'Title', 'ProductCode', 'ProductURL',
-                       failed_only=False).run()
-    SupplierImageDownloader(supplier_path=supplier_path).run()
+    columns = ['Title', 'ProductCode', 'ProductURL']
+    ws = WorksheetImporter(supplier_path=supplier_path, columns=columns,
+                           filename=filename).worksheet
+    page_getter = SupplierPageGetter(ws, supplier_path, *columns, failed_only=False)
+    archiver = Archiver(supplier_path, 'Kentia', incremental=incremental)
+    downloader = SupplierImageDownloader(supplier_path=supplier_path, on_image=archiver.add,
+                                         resources=resources)
+    run_pipeline(page_getter, downloader, engine=engine, stream=stream)
     ic = IntegrityChecker(log=True, supplier_path=supplier_path)
-    Archiver(supplier_path, 'Kentia', ic).run()
+    archiver.integrity = bool(ic)
+    archiver.run()
 
 
 if __name__ == '__main__':
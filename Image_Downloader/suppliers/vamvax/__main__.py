@@ -14,6 +14,8 @@ from ...backend.pagegetter import ProductPageGetter
 from ...backend.worksheet import WorksheetImporter
 from ...backend.downloader import ImageDownloader
 from ...backend.utils import IntegrityChecker, Archiver
+from ...backend.pipeline import run_pipeline
+from ...backend.resources import SharedResources
 from ...backend.poonto.imagecropper import resize_image
 
 
@@ -48,24 +50,38 @@ class SupplierImageDownloader(ImageDownloader):
     Standard Poonto image transformation.
     '''
 
+    transform_key = 'poonto-resize'
+    transform_params = {'dimensions': (740, 740)}
+
     def transform_image(self, image: bytes, filename: str) -> bytes:
         ext = filename.rsplit('.', maxsplit=1)[-1]
-        return resize_image(image, (740, 740), ext)
+        return resize_image(image, extension=ext, **self.transform_params)
 
 
-def main():
+def main(engine: str = 'threads', stream: bool = True, incremental: bool = False,
+         filename: str | None = None, resources: SharedResources | None = None):
     '''
     The function to be called by controller.py.
     Don't attempt to run as top level.
+
+    engine is either 'threads' or 'async'.
+    stream downloads the images while the pages are still being scraped.
+    incremental keeps the images and archives only what changed since the last run.
+    filename is the file to read instead of the one on the command line, and
+    resources the pools shared with other suppliers running at the same time.
     '''
 
-    ws = WorksheetImporter(supplier_path=supplier_path).worksheet
-    SupplierPageGetter(ws, supplier_path,
-                       'Title', 'ProductCode', 'ProductURL',
-                       failed_only=False).run()
-    SupplierImageDownloader(supplier_path=supplier_path).run()
+    columns = ['Title', 'ProductCode', 'ProductURL']
+    ws = WorksheetImporter(supplier_path=supplier_path, columns=columns,
+                           filename=filename).worksheet
+    page_getter = SupplierPageGetter(ws, supplier_path, *columns, failed_only=False)
+    archiver = Archiver(supplier_path, 'Vamvax', incremental=incremental)
+    downloader = SupplierImageDownloader(supplier_path=supplier_path, on_image=archiver.add,
+                                         resources=resources)
+    run_pipeline(page_getter, downloader, engine=engine, stream=stream)
     ic = IntegrityChecker(log=True, supplier_path=supplier_path)
-    Archiver(supplier_path, 'Vamvax', ic).run()
+    archiver.integrity = bool(ic)
+    archiver.run()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,244 @@
+'''
+Runs the job service against a fake image server and checks its HTTP API end
+to end: submitting jobs as JSON and as uploads, rejecting empty, truncated and
+invalid submissions, the per client queue limit, cancelling, following the
+logs and downloading the archives.
+
+Usage:
+python -m pytest tests
+python -m tests.test_jobservice
+
+The jobs run a copy of the artelibre supplier. It is placed in a temporary
+directory together with the service data and the image store, and the
+package itself is never written to.
+'''
+
+import io
+import json
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from PIL import Image
+
+from Image_Downloader.backend.jobservice import JobServer, JobService
+from Image_Downloader.backend.orchestrator import suppliers_path
+
+# Not the name of a packaged supplier, or the service would run that one instead
+SUPPLIER = 'servicecheck_supplier'
+
+
+class FakeImageHandler(BaseHTTPRequestHandler):
+    '''
+    Serves /img<n>.jpg, a JPEG of a colour of its own for every n.
+    '''
+
+    def do_GET(self): # pylint: disable=invalid-name
+        '''
+        Sends the image.
+        '''
+        name = self.path.strip('/')
+        if not (name.startswith('img') and name.endswith('.jpg') and name[3:-4].isdigit()):
+            self.send_error(404)
+            return
+        n = int(name[3:-4])
+        with io.BytesIO() as buffer:
+            Image.new('RGB', (1200, 900), (n * 40 % 256, n * 80 % 256, 200)).save(buffer, 'jpeg')
+            content = buffer.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+
+def feed(prefix: str, image_server: str, count: int) -> bytes:
+    '''
+    An artelibre feed of count products, each with one image of image_server.
+    '''
+    products = ''.join(
+        f'<Product><sku>{prefix}{i}</sku><images>'
+        f'<image>{image_server}/img{i % 5}.jpg</image></images></Product>'
+        for i in range(count)
+    )
+    return f'<?xml version="1.0"?><Products>{products}</Products>'.encode()
+
+
+class ServiceCheck:
+    '''
+    Starts the servers with their data in work_dir, runs the checks and reports them.
+    '''
+
+    def __init__(self, work_dir: Path):
+        self.failures = 0
+        self.work_dir = work_dir
+        self.package_store = (suppliers_path / '.imagestore').exists()
+        self.suppliers_dir = work_dir / 'suppliers'
+        supplier_dir = self.suppliers_dir / SUPPLIER
+        supplier_dir.mkdir(parents=True)
+        for name in ('__init__.py', '__main__.py'):
+            shutil.copy(suppliers_path / 'artelibre' / name, supplier_dir / name)
+        self.images = ThreadingHTTPServer(('127.0.0.1', 0), FakeImageHandler)
+        self.service = JobService(work_dir / 'service', workers=1,
+                                  max_queued_per_client=2, transform_processes=1,
+                                  suppliers_dir=self.suppliers_dir,
+                                  store_root=work_dir / 'imagestore')
+        self.server = JobServer(('127.0.0.1', 0), self.service)
+        self.base = f'http://127.0.0.1:{self.server.server_address[1]}'
+        image_server = f'http://127.0.0.1:{self.images.server_address[1]}'
+        self.feeds = {}
+        for prefix in ('A', 'B'):
+            self.feeds[prefix] = self.work_dir / f'{prefix}.xml'
+            self.feeds[prefix].write_bytes(feed(prefix, image_server, 6))
+
+    def check(self, name: str, passed: bool, detail='') -> None:
+        '''
+        Reports a check.
+        '''
+        if not passed:
+            self.failures += 1
+        print(f"{'ok' if passed else 'FAILED'} - {name}{f': {detail}' if detail else ''}")
+
+    def request(self, method: str, path: str, body: bytes | None = None,
+                headers: dict[str, str] | None = None) -> tuple[int, bytes, dict[str, str]]:
+        '''
+        Sends a request to the service and returns the status, body and headers.
+        '''
+        request = urllib.request.Request(self.base + path, data=body, method=method,
+                                         headers=headers or {})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, response.read(), dict(response.headers)
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), dict(e.headers)
+
+    def submit(self, job: dict, client: str) -> tuple[int, bytes, dict[str, str]]:
+        '''
+        Submits job as JSON.
+        '''
+        return self.request('POST', '/jobs', json.dumps(job).encode(),
+                            {'Content-Type': 'application/json', 'X-Client-Id': client})
+
+    def truncated_upload(self) -> int:
+        '''
+        Uploads a file that ends before its Content-Length, like a client that
+        disconnected, and returns the status of the answer.
+        '''
+        port = self.server.server_address[1]
+        with socket.create_connection(('127.0.0.1', port), timeout=30) as connection:
+            connection.sendall(f'POST /jobs?supplier={SUPPLIER}&filename=cut.xml HTTP/1.1\r\n'
+                               'Host: 127.0.0.1\r\nContent-Length: 1000\r\n'
+                               'Connection: close\r\n\r\n<?xml'.encode())
+            connection.shutdown(socket.SHUT_WR)
+            answer = b''
+            while chunk := connection.recv(65536):
+                answer += chunk
+        return int(answer.split(b' ', 2)[1])
+
+    def uploads(self) -> list[Path]:
+        '''
+        The uploaded files the service keeps.
+        '''
+        uploads_dir = self.service.uploads_dir
+        return list(uploads_dir.iterdir()) if uploads_dir.exists() else []
+
+    def run(self) -> bool:
+        '''
+        Runs the checks and returns whether they all passed.
+        '''
+        threading.Thread(target=self.images.serve_forever, daemon=True).start()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        try:
+            self._submissions()
+            # The workers start after the submissions, so the queue limits are predictable
+            self.service.start()
+            self._jobs()
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            self.service.stop()
+            self.service.queue.close()
+            self.images.shutdown()
+            self.images.server_close()
+        print(f'{self.failures} checks failed' if self.failures else 'All checks passed')
+        return not self.failures
+
+    def _submissions(self) -> None:
+        status, body, headers = self.submit({'supplier': SUPPLIER, 'file': str(self.feeds['A'])}, 'A')
+        self.check('JSON job accepted', status == 201 and headers.get('Location') == '/jobs/1', body)
+        status, body, _ = self.request(
+            'POST', f'/jobs?supplier={SUPPLIER}&filename=B.xml&engine=async',
+            self.feeds['B'].read_bytes(), {'X-Client-Id': 'A'}
+        )
+        self.check('uploaded job accepted', status == 201, body)
+        self.check('upload kept', len(self.uploads()) == 1)
+
+        status, body, headers = self.submit({'supplier': SUPPLIER, 'file': str(self.feeds['A'])}, 'A')
+        self.check('queue limit of a client', status == 429 and 'Retry-After' in headers, status)
+        status, body, _ = self.submit({'supplier': 'no_such_supplier', 'file': str(self.feeds['A'])}, 'B')
+        self.check('unknown supplier rejected', status == 400, body)
+
+        status, body, _ = self.request('POST', f'/jobs?supplier={SUPPLIER}&filename=empty.xml',
+                                       b'', {'X-Client-Id': 'B'})
+        self.check('empty upload rejected', status == 400, body)
+        self.check('truncated upload rejected', self.truncated_upload() == 400)
+        self.check('rejected uploads deleted', len(self.uploads()) == 1, self.uploads())
+
+        status, body, _ = self.submit({'supplier': SUPPLIER, 'file': str(self.feeds['B'])}, 'B')
+        self.check('other client accepted', status == 201, body)
+        status, body, _ = self.request('DELETE', '/jobs/3')
+        self.check('queued job cancelled', status == 200, body)
+        status, body, _ = self.request('DELETE', '/jobs/3')
+        self.check('cancelled job not cancelled again', status == 409, body)
+
+    def _jobs(self) -> None:
+        status, log, _ = self.request('GET', '/jobs/1/logs')
+        self.check('log followed to the end', status == 200 and log.strip() != b'', log[-200:])
+        deadline = time.monotonic() + 300
+        while time.monotonic() < deadline:
+            jobs = json.loads(self.request('GET', '/jobs')[1])
+            if not any(job['state'] in ('queued', 'running') for job in jobs):
+                break
+            time.sleep(0.5)
+        states = {job['id']: job['state'] for job in jobs}
+        self.check('jobs ended', states == {1: 'done', 2: 'done', 3: 'cancelled'}, states)
+        self.check('uploads deleted after the jobs', not self.uploads(), self.uploads())
+
+        for job_id in (1, 2):
+            status, data, headers = self.request('GET', f'/jobs/{job_id}/archive')
+            names = zipfile.ZipFile(io.BytesIO(data)).namelist() if status == 200 else []
+            images = [name for name in names if name.endswith('.jpg')]
+            self.check(f'archive of job {job_id}', len(images) == 6 and
+                       'attachment' in headers.get('Content-Disposition', ''), names)
+        status, _, _ = self.request('GET', '/jobs/3/archive')
+        self.check('no archive for a cancelled job', status == 404, status)
+        self.check('images stored in the given store',
+                   any((self.work_dir / 'imagestore' / 'objects').glob('*/*')))
+        self.check('supplier data kept in the temporary directory',
+                   (self.suppliers_dir / SUPPLIER / 'links.txt').exists())
+        self.check('package left alone', not (suppliers_path / SUPPLIER).exists() and
+                   (suppliers_path / '.imagestore').exists() == self.package_store)
+
+
+def test_job_service():
+    '''
+    The checks, for pytest.
+    '''
+    with tempfile.TemporaryDirectory() as work_dir:
+        assert ServiceCheck(Path(work_dir)).run()
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as temporary:
+        sys.exit(0 if ServiceCheck(Path(temporary)).run() else 1)